@@ -1,6 +1,9 @@
 import pandas as pd
+import numpy as np
 import argparse
 
+from latent_io import read_header, read_table, iter_table, TableWriter, write_table
+
 
 # Module that aggregates the ground truth or predicted labels from a 1-N mapping CSV
 # The content of the labels are expected to be already available in one-hot-encoding format but no normalization is required nor enforced
@@ -8,87 +11,219 @@ import argparse
 # Sets are defined as collection of rows sharing the same UUID (unique identifier)
 
 
-def aggregate_labels(input_file, output_file, labels_column, uuid_column):
-    # Load the CSV data into a DataFrame
-    df = pd.read_csv(input_file)
-
-    # Initialize an empty DataFrame to store the aggregated data
-    output_df = pd.DataFrame(columns=df.columns)
+# Reducers available to aggregate the columns of each set:
+# mean, median, max: statistic of each column over the set (NaN values are skipped)
+# count: number of non-NaN values of each column in the set
+# vote: majority vote, each row votes for its argmax column and the set gets the one-hot encoding of the most voted column (ties go to the first column)
+#       Sets where all the rows are NaN have no votes and get NaN
+# wmean: mean weighted by another column (e.g. distance or confidence), given as prefix:wmean:weight_column
+REDUCERS = ["mean", "median", "max", "count", "vote", "wmean"]
+
+
+def parse_reducer(spec):
+    """
+    Parse a reducer specification with the format prefix:reducer[:weight_column] (e.g., labels_:mean, pred_:wmean:confidence).
+
+    Outputs:
+    - (prefix, reducer, weight_column) tuple. weight_column is None except for the wmean reducer.
+    """
+    fields = spec.split(":")
+    if len(fields) < 2 or fields[1] not in REDUCERS:
+        raise ValueError("Invalid reducer [" + spec + "]. Expected prefix:reducer[:weight_column], reducers: " + ", ".join(REDUCERS))
+    prefix, reducer = fields[0], fields[1]
+    if reducer == "wmean":
+        if len(fields) != 3:
+            raise ValueError("The wmean reducer requires a weight column: prefix:wmean:weight_column")
+        return prefix, reducer, fields[2]
+    if len(fields) != 2:
+        raise ValueError("Invalid reducer [" + spec + "]. Only the wmean reducer takes a weight column")
+    return prefix, reducer, None
+
+
+def _reduce_columns(df, columns, grouped, set_id, reducer, weight_column):
+    # Apply a reducer over the columns of each set. grouped is the group-by over the set ids, shared by all the reducers
+    if reducer == "mean":
+        return grouped[columns].mean().to_numpy()
+    elif reducer == "median":
+        return grouped[columns].median().to_numpy()
+    elif reducer == "max":
+        return grouped[columns].max().to_numpy()
+    elif reducer == "count":
+        return grouped[columns].count().to_numpy()
+    elif reducer == "vote":
+        # One-hot encoding of the argmax of each row, then the most voted column of each set
+        values = df[columns].to_numpy(dtype=np.float64)
+        votes = np.zeros(values.shape, dtype=np.int64)
+        valid = ~np.all(np.isnan(values), axis=1)
+        votes[np.flatnonzero(valid), np.nanargmax(values[valid], axis=1)] = 1
+        votes = pd.DataFrame(votes).groupby(set_id, sort=True).sum().to_numpy()
+        one_hot = (np.arange(len(columns)) == votes.argmax(axis=1)[:, np.newaxis]).astype(np.float64)
+        # Sets without votes (all their rows are NaN) get NaN, as with the mean reducers
+        one_hot[votes.sum(axis=1) == 0] = np.nan
+        return one_hot
+    elif reducer == "wmean":
+        # Sum of the weighted values over the sum of the weights, NaN values do not contribute to either sum
+        values = df[columns].to_numpy(dtype=np.float64)
+        weights = df[weight_column].to_numpy(dtype=np.float64)[:, np.newaxis] * ~np.isnan(values)
+        sums = pd.DataFrame(np.nan_to_num(values) * weights).groupby(set_id, sort=True).sum().to_numpy()
+        total_weights = pd.DataFrame(weights).groupby(set_id, sort=True).sum().to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return sums / total_weights
+    raise ValueError("Unknown reducer: " + str(reducer))
+
+
+def aggregate_dataframe(df, labels_column, uuid_column, reducers=None):
+    """
+    Aggregate the labels of a 1-N mapping dataframe by UUID.
+
+    Sets are runs of consecutive rows sharing the same UUID. The labels (columns starting with labels_column) are averaged,
+    and the rest of the columns are copied from the first row of each set. The output keeps the order of the sets in the input.
+    Additional reducers can be applied to other groups of columns; all of them share a single group-by over the sets.
+
+    Inputs:
+    - df: input dataframe.
+    - labels_column: prefix of the label columns (e.g., labels_) aggregated with the mean. Can be None if reducers are provided.
+    - uuid_column: name of the unique identifier column.
+    - reducers: list of (prefix, reducer, weight_column) tuples, see parse_reducer and REDUCERS.
+
+    Outputs:
+    - output_df: dataframe with one row per set.
+    """
+    if labels_column is not None:
+        reducers = [(labels_column, "mean", None)] + list(reducers or [])
+
+    # A new set starts whenever the UUID differs from the one in the previous row
+    uuid = df[uuid_column]
+    new_set = (uuid != uuid.shift()).to_numpy()
+    set_id = np.cumsum(new_set) - 1
+
+    # Copy the first row of each set, and replace the aggregated columns by the output of their reducer
+    output_df = df.iloc[np.flatnonzero(new_set)].reset_index(drop=True)
+    # The set ids are increasing, so the sorted group-by keeps the order of the sets
+    grouped = df.groupby(set_id, sort=True)
+    for prefix, reducer, weight_column in reducers or []:
+        columns = df.columns[df.columns.str.startswith(prefix)]
+        if len(columns) > 0:
+            output_df[columns] = _reduce_columns(df, columns, grouped, set_id, reducer, weight_column)
+
+    return output_df
+
+
+def aggregate_labels(input_file, output_file, labels_column, uuid_column, chunksize=None, reducers=None):
+    # In streaming mode the input is read in chunks and the output is written incrementally
+    if chunksize is not None:
+        return aggregate_labels_streaming(input_file, output_file, labels_column, uuid_column, chunksize, reducers)
 
-    # Initialize variables to keep track of the current UUID and rows for aggregation
-    current_uuid = None
-    rows_to_aggregate = []
+    # Load the CSV data into a DataFrame
+    df = read_table(input_file)
 
     print("Aggregating labels in the input CSV file...")
     N = len(df)
     print("Total number of rows: %d" % N)
 
-    unique_rows = 1
-    # Iterate over each row in the input DataFrame
-    for index, row in df.iterrows():
-        if row[uuid_column] != current_uuid:
-            # If a new UUID is encountered, aggregate the labels for the previous UUID
-            if current_uuid is not None:
-                aggregated_labels = pd.DataFrame(rows_to_aggregate).mean()
-                output_row = df.loc[index - 1].copy()  # Copy the first input row
-                output_row[
-                    df.columns[df.columns.str.startswith(labels_column)]
-                ] = aggregated_labels
-                # Let's append the output_row to the dataframe
-                # output_df = output_df.append(output_row, ignore_index=True)
-                # use concat to append the output_row to the dataframe
-                # first convert the output_row to a dataframe
-                output_row = pd.DataFrame(output_row).transpose()
-                # then use concat to append the output_row to the dataframe
-                output_df = pd.concat([output_df, output_row], ignore_index=True)
-
-            # Reset variables for the new UUID
-            current_uuid = row[uuid_column]
-            rows_to_aggregate = []
-            unique_rows += 1
-            # print every 10 unique rows
-            if unique_rows % 20 == 0:
-                print("Unique rows processed: %d /" % unique_rows, N)
-
-        # Collect rows with the same UUID for aggregation
-        rows_to_aggregate.append(row[df.columns.str.startswith(labels_column)])
-
-    # Aggregate the labels for the last UUID encountered
-    if current_uuid is not None:
-        aggregated_labels = pd.DataFrame(rows_to_aggregate).mean()
-        output_row = df.loc[len(df) - 1].copy()  # Copy the last input row
-        output_row[
-            df.columns[df.columns.str.startswith(labels_column)]
-        ] = aggregated_labels
-        output_row = pd.DataFrame(output_row).transpose()
-        # then use concat to append the output_row to the dataframe
-        output_df = pd.concat([output_df, output_row], ignore_index=True)
-        # output_df = output_df.append(output_row, ignore_index=True)
+    output_df = aggregate_dataframe(df, labels_column, uuid_column, reducers)
 
-    print("Total number of unique rows: %d" % unique_rows)
+    print("Total number of unique rows: %d" % len(output_df))
 
     # Save the aggregated data to a new CSV file
-    output_df.to_csv(output_file, index=False)
+    write_table(output_df, output_file)
+
+
+def aggregate_labels_streaming(input_file, output_file, labels_column, uuid_column, chunksize, reducers=None):
+    # Streaming version of aggregate_labels for inputs where the rows of each UUID are contiguous
+    # The last set of each chunk may continue in the next chunk, so it is held back and prepended to the next chunk
+    # Memory is bounded by the chunk size (plus the size of the largest set), and finished sets are written as soon as they are complete
+    print("Aggregating labels in the input CSV file (streaming, %d rows per chunk)..." % chunksize)
+    N = 0
+    unique_rows = 0
+    writer = TableWriter(output_file)
+    open_set = None
+
+    for chunk in iter_table(input_file, chunksize):
+        if len(chunk) == 0:
+            continue
+        N += len(chunk)
+        if open_set is not None:
+            chunk = pd.concat([open_set, chunk], ignore_index=True)
+
+        # Find where the last set of the chunk starts
+        uuid = chunk[uuid_column]
+        last_start = np.flatnonzero((uuid != uuid.shift()).to_numpy())[-1]
+        open_set = chunk.iloc[last_start:]
+
+        output_df = aggregate_dataframe(chunk.iloc[:last_start], labels_column, uuid_column, reducers)
+        writer.write(output_df)
+        unique_rows += len(output_df)
+        print("Rows processed: %d, unique rows written: %d" % (N, unique_rows))
+
+    # Aggregate the last set
+    if open_set is not None:
+        output_df = aggregate_dataframe(open_set, labels_column, uuid_column, reducers)
+        writer.write(output_df)
+        unique_rows += len(output_df)
+    else:
+        # Empty input, only the header is exported
+        writer.write(pd.DataFrame(columns=read_header(input_file)))
+    writer.close()
 
+    print("Total number of rows: %d" % N)
+    print("Total number of unique rows: %d" % unique_rows)
 
-if __name__ == "__main__":
+
+def main(args=None):
     parser = argparse.ArgumentParser(
         description="Aggregate labels in a CSV file by UUID"
     )
     parser.add_argument(
-        "--input", required=True, help="Input CSV file path [mandatory]"
+        "--input", required=True, help="Input CSV file path [mandatory]. Parquet and Feather files are also accepted"
     )
     parser.add_argument(
-        "--output", required=True, help="Output CSV file path [mandatory]"
+        "--output", required=True, help="Output CSV file path [mandatory]. Parquet and Feather outputs are selected by extension"
     )
     parser.add_argument(
-        "--labels", required=True, help="Name of the labels column (e.g., labels_) that will be aggregated. They are expected to be numerical values"
+        "--labels", default=None, help="Name of the labels column (e.g., labels_) that will be aggregated with the mean. They are expected to be numerical values. Mandatory unless --reduce is provided"
+    )
+    parser.add_argument(
+        "--reduce",
+        action="append",
+        default=[],
+        help="Additional reducer applied to the columns starting with a prefix, as prefix:reducer[:weight_column] (e.g., pred_:vote, labels_:wmean:confidence). Reducers: " + ", ".join(REDUCERS) + ". Can be repeated, all the reducers are computed in a single pass",
     )
     parser.add_argument(
         "--uuid",
         required=True,
         help="Name of unique identifier column (e.g., relative_path, UUID). This key will be used to define the set of rows that will be aggregated into a single output row",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Number of rows read at once. If provided, the input is processed in streaming mode: rows of the same UUID must be contiguous (as in the in-memory mode) and the output is written incrementally",
+    )
+    args = parser.parse_args(args)
+
+    if args.chunksize is not None and args.chunksize < 1:
+        print("The chunk size must be a positive integer.")
+        exit()
+
+    if args.labels is None and not args.reduce:
+        print("At least one of --labels or --reduce must be provided.")
+        exit()
+    try:
+        reducers = [parse_reducer(spec) for spec in args.reduce]
+    except ValueError as e:
+        print(e)
+        exit()
 
-    aggregate_labels(args.input, args.output, args.labels, args.uuid)
+    # Check that the weight columns exist in the input file
+    columns = read_header(args.input)
+    for prefix, reducer, weight_column in reducers:
+        if weight_column is not None and weight_column not in columns:
+            print("Weight column [" + weight_column + "] not found in the input file.")
+            exit()
+
+    aggregate_labels(args.input, args.output, args.labels, args.uuid, args.chunksize, reducers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,156 @@
 # Python script that reads a CSV file containing rows with georeferenced entries. There are two columns named latitude and longitude.
-# The script reads the CSV file and convert the latitude and longitude values to northing and easting values using the UTM projection. The UTM zone is determined by the longitude value.
+# The script reads the CSV file and convert the latitude and longitude values to northing and easting values using the UTM projection.
+# The UTM zone and hemisphere are determined for each entry by its longitude and latitude, unless a zone is provided with --zone.
 # The first row contains the header, we use the header to determine the column index of the latitude and longitude values.
-# Data is stored in a pandas dataframe and written to a new CSV file.
+# The file is read and written in chunks of rows, so only one chunk is held in memory. For CSV files (plain or .gz, .bz2, .xz), only the
+# latitude and longitude values are parsed (as float64): each line is passed through untouched (as raw bytes) and the UTM values are
+# appended to it.
+# Parquet and Feather inputs/outputs are also accepted (selected by extension), their columns keep their types.
 
+import bz2
+import gzip
+import io
+import itertools
+import lzma
+import os
 import sys
-import csv
-import pyproj
+import numpy as np
 import pandas as pd
 import argparse
 
-#TODO: Refactor to add main function as entrypoint (required for pyproject.toml console script installation)
+from geo import latlon_to_utm, parse_zone, zone_counts, report_zones
+from latent_io import read_header, iter_table, table_format, TableWriter
+
+LATITUDE_KEY = 'latitude [deg]'
+LONGITUDE_KEY = 'longitude [deg]'
+NORTHING_KEY = 'northing_utm [m]'
+EASTING_KEY = 'easting_utm [m]'
+
+# Compressed CSV files that can be read and written line by line, and the function opening them (in binary mode)
+RAW_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+# Other compressions (read and written through pandas)
+COMPRESSED_EXTENSIONS = ['.zst', '.zip']
+
+
+def is_raw_csv(filename):
+    """True if the file is a CSV file (plain or compressed with gzip, bz2 or xz) whose lines can be passed through as raw bytes."""
+    return table_format(filename) == 'csv' and os.path.splitext(filename)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def open_raw(filename, mode='r'):
+    """Open a (possibly compressed) CSV file in binary mode, so its lines are passed through byte for byte."""
+    opener = RAW_OPENERS.get(os.path.splitext(filename)[1].lower(), open)
+    return opener(filename, mode + 'b')
+
+
+def read_raw_chunks(filename, chunksize, header):
+    """
+    Read a CSV file in chunks of raw lines. Only the latitude and longitude columns are parsed, the lines are kept as bytes.
+
+    Inputs:
+    - filename: path to the CSV file.
+    - chunksize: number of lines per chunk.
+    - header: list of column names of the file.
+
+    Outputs:
+    - iterator of (lines, lat, lon) tuples: list of lines (bytes, without line terminator) and float64 arrays of latitudes and longitudes.
+    """
+    columns = [header.index(LATITUDE_KEY), header.index(LONGITUDE_KEY)]
+    with open_raw(filename) as f:
+        f.readline()
+        while True:
+            lines = [line.rstrip(b'\r\n') for line in itertools.islice(f, chunksize)]
+            if not lines:
+                break
+            # Blank lines are skipped, as pandas does
+            lines = [line for line in lines if line]
+            if not lines:
+                continue
+            text = b'\n'.join(lines)
+            try:
+                # Exact (round trip) parsing of the coordinates
+                coords = pd.read_csv(io.BytesIO(text), header=None, usecols=columns, dtype=np.float64,
+                                     float_precision='round_trip')
+                lat, lon = coords[columns[0]].to_numpy(), coords[columns[1]].to_numpy()
+            except ValueError:
+                # Some values are not numbers, parse the two columns as text (invalid values are NaN)
+                coords = pd.read_csv(io.BytesIO(text), header=None, usecols=columns, dtype=str, na_filter=False)
+                lat, lon = parse_coordinate(coords[columns[0]]), parse_coordinate(coords[columns[1]])
+            del text
+            if len(lat) != len(lines):
+                raise ValueError("The rows of " + filename + " span several lines (quoted line breaks), which is not supported")
+            yield lines, lat, lon
+
+
+def utm_lines(lines, northing, easting):
+    """
+    Append the UTM coordinates to raw CSV lines (same float formatting as pandas, NaN values are empty).
+
+    Outputs:
+    - iterator of lines (bytes, with line terminator).
+    """
+    for line, n, e in zip(lines, northing.tolist(), easting.tolist()):
+        yield line + (',' + (repr(n) if n == n else '') + ',' + (repr(e) if e == e else '') + '\n').encode()
+
+
+def parse_coordinate(column):
+    """
+    Parse a column of coordinates (degrees) as float64. Empty or invalid values are NaN.
+    """
+    if column.dtype == np.float64:
+        return column.to_numpy()
+    try:
+        # Exact (round trip) parsing of the text values
+        return column.replace('', 'nan').astype(np.float64).to_numpy()
+    except (ValueError, TypeError):
+        return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+
+
+class CoordinateSummary:
+    """
+    Running summary (count, mean, standard deviation, min, max) of a coordinate, updated chunk by chunk.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.offset = 0.0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        # Values are centred on the first one to keep the sum of squares accurate for large coordinates (e.g. northing)
+        if self.count == 0:
+            self.offset = values[0]
+        self.count += len(values)
+        centred = values - self.offset
+        self.total += centred.sum()
+        self.total_sq += np.dot(centred, centred)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def summary(self):
+        if self.count == 0:
+            return pd.Series({'count': 0})
+        mean = self.total / self.count
+        std = np.sqrt(max(self.total_sq - self.count * mean ** 2, 0) / (self.count - 1)) if self.count > 1 else np.nan
+        return pd.Series({'count': self.count, 'mean': self.offset + mean, 'std': std, 'min': self.min, 'max': self.max})
+
 
 def main(args=None):
     parser = argparse.ArgumentParser(
-        description="Calculate and plot the confusion matrix from a CSV file containing the predictions and targets"
+        description="Append the UTM coordinates (northing, easting) of the latitude and longitude of the entries of a CSV file"
     )
     parser.add_argument(
         "--input",
         "-i",
         type=str,
         required=True,
-        help="Path to the input CSV file with the predictions and targets",
+        help="Path to the input CSV file with the georeferenced entries (latitude [deg], longitude [deg])",
     )
     # Output filename is optional
     parser.add_argument(
@@ -28,13 +158,26 @@ def main(args=None):
         "-o",
         type=str,
         default=None,
-        help="Path to the output file with the confusion matrix image",
+        help="Path to the output CSV file. Default: input filename with _utm appended to it",
+    )
+    parser.add_argument(
+        "--chunksize",
+        "-c",
+        type=int,
+        default=100000,
+        help="Number of rows read, converted and written at once (default: 100000)",
+    )
+    parser.add_argument(
+        "--zone",
+        "-z",
+        type=str,
+        default=None,
+        help="UTM zone used to project all the entries, e.g. 30N or 30S. Default: the zone and hemisphere of each entry",
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     # Check if the provided file exists
     # If the file does not exist, the script will exit
-    try:
     try:
         with open(args.input, "r") as f:
             pass
@@ -42,6 +185,13 @@ def main(args=None):
         print("Provided input file: [" + args.input + "] not found.")
         exit()
     filename = args.input
+
+    if args.zone is not None:
+        try:
+            parse_zone(args.zone)
+        except ValueError as e:
+            print(e.args[0])
+            exit()
         
     # Check if an output filename is provided (second argumnt)
     # If no output filename is provided, we append '_utm' to the input filename
@@ -53,48 +203,75 @@ def main(args=None):
         print ('Output filename provided.')
         filename_out = args.output
 
-    # Read the CSV file
-    with open(filename, 'r') as f:
-        reader = csv.reader(f)
-        data = list(reader)
+    if args.chunksize < 1:
+        print ('The chunk size must be a positive integer.')
+        exit()
 
     # Get the header and determine the column index of the latitude and longitude values
-    header = data[0]
+    header = list(read_header(filename))
     # TODO: User configurable header keys. This could be retrieved from oplab config.yaml
     # Check if the header contains the latitude and longitude keys
-    if 'latitude [deg]' not in header or 'longitude [deg]' not in header:
+    if LATITUDE_KEY not in header or LONGITUDE_KEY not in header:
         print('The header does not contain the "latitude [deg]" and/or "longitude [deg]" keys.')
         exit()
 
-    lat_index = header.index('latitude [deg]')
-    lon_index = header.index('longitude [deg]')
+    zones = {}
+    northing_summary = CoordinateSummary()
+    easting_summary = CoordinateSummary()
+    rows = 0
 
-    # Create a pandas dataframe
-    df = pd.DataFrame(data[1:], columns=header)
+    def convert(lat, lon):
+        # Convert the latitude and longitude values to northing and easting values. Entries without valid values get empty UTM coordinates
+        # The UTM zone (and hemisphere) of each entry is determined from its latitude and longitude values
+        northing, easting, epsg = latlon_to_utm(lat, lon, args.zone)
+        for code, count in zone_counts(epsg).items():
+            zones[code] = zones.get(code, 0) + count
+        northing_summary.update(northing)
+        easting_summary.update(easting)
+        return northing, easting
 
-    # Determine the UTM zone using the latitude and longitude values
-    utm_zone = int((float(df.iloc[0, lon_index]) + 180) / 6) + 1
-    # Print the UTM zone
-    print ('UTM zone: ' + str(utm_zone))
-
-    # Create a UTM projection
-    utm = pyproj.Proj(proj='utm', zone=utm_zone, ellps='WGS84', datum='WGS84')
+    # Read, convert and write the file chunk by chunk
+    # CSV files (plain, gzip, bz2 or xz) without UTM columns are processed as raw lines: the UTM values are appended to each line
+    # Otherwise (binary formats, other compressions, or existing UTM columns to overwrite) the chunks are read as typed dataframes
+    if is_raw_csv(filename) and is_raw_csv(filename_out) and NORTHING_KEY not in header and EASTING_KEY not in header:
+        with open_raw(filename) as f:
+            header_line = f.readline().rstrip(b'\r\n')
+        try:
+            with open_raw(filename_out, 'w') as out:
+                out.write(header_line + (',' + NORTHING_KEY + ',' + EASTING_KEY + '\n').encode())
+                for lines, lat, lon in read_raw_chunks(filename, args.chunksize, header):
+                    northing, easting = convert(lat, lon)
+                    out.writelines(utm_lines(lines, northing, easting))
+                    rows += len(lines)
+        except ValueError as e:
+            print(e.args[0])
+            os.remove(filename_out)
+            exit()
+    else:
+        with TableWriter(filename_out) as writer:
+            if table_format(filename) == 'csv':
+                # Exact (round trip) parsing, so the float values are written back unchanged
+                chunks = pd.read_csv(filename, chunksize=args.chunksize, float_precision='round_trip')
+            else:
+                chunks = iter_table(filename, args.chunksize)
+            for df in chunks:
+                northing, easting = convert(parse_coordinate(df[LATITUDE_KEY]), parse_coordinate(df[LONGITUDE_KEY]))
+                df[NORTHING_KEY] = northing
+                df[EASTING_KEY] = easting
+                writer.write(df)
+                rows += len(df)
 
-    # Convert the latitude and longitude values to northing and easting values
-    df['northing_utm [m]'], df['easting_utm [m]'] = utm(df.iloc[:, lon_index].values, df.iloc[:, lat_index].values)
+    # Print the UTM zone(s)
+    report_zones(zones)
 
     # Print summary information about northen and easting values. Let's print min, mean, max, and standard deviation.
     print ('Northing UTM [m]:')
-    print (df['northing_utm [m]'].describe())
+    print (northing_summary.summary())
     print ('Easting UTM [m]:')
-    print (df['easting_utm [m]'].describe())
-
-
-    # Write the dataframe to a new CSV file
-    df.to_csv(filename_out, index=False)
+    print (easting_summary.summary())
 
     # Print the total number of rows processed
-    print ('\n------------------\nTotal number of rows processed: ' + str(len(df)))
+    print ('\n------------------\nTotal number of rows processed: ' + str(rows))
 
 
 if __name__ == "__main__":
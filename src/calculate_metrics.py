@@ -3,21 +3,405 @@
 
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
+import glob
+import multiprocessing
 import argparse
 
+from latent_io import read_header, iter_table
+
+
+def _scores_from_counts(confusion_matrix, brier_sum, uncertainty_sum, num_samples):
+    """
+    Compute the scores from the accumulated confusion matrix, squared errors and uncertainties.
+
+    Inputs:
+    - confusion_matrix: matrix of size C x C with the number of samples per (target, predicted) class.
+    - brier_sum: vector of size C with the sum of the squared error between target and predicted values, per class.
+    - uncertainty_sum: vector of size C with the sum of the uncertainty, per class.
+    - num_samples: number of samples.
+
+    Outputs:
+    - scores: dictionary with the confusion matrix (raw counts and normalized per target class), Brier score (raw-MSE),
+      mean uncertainty, MCC, accuracy, recall, precision and F1 score per class, and the weighted accuracy and F1 score.
+    """
+    brier_score_raw = brier_sum / num_samples
+    uncertainty = uncertainty_sum / num_samples
+
+    # Calculate each component TP, TN, FP, FN
+    TP = np.diag(confusion_matrix)
+    TN = np.sum(confusion_matrix) - (
+        np.sum(confusion_matrix, axis=0) + np.sum(confusion_matrix, axis=1) - TP
+    )
+    FP = np.sum(confusion_matrix, axis=0) - TP
+    FN = np.sum(confusion_matrix, axis=1) - TP
+
+    # Normalize the confusion matrices (normalizing before or after calculating the components does not change the results)
+    confusion_matrix_norm = confusion_matrix / confusion_matrix.sum(axis=1)[:, np.newaxis]
+    # Calculate the Matthews Correlation Coefficient (MCC)
+    # MCC = (TP * TN - FP * FN) / sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+    mcc = (TP * TN - FP * FN) / np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
+
+    # Calculate the accuracy for each class from the confusion matrix
+    accuracy = np.diag(confusion_matrix_norm)
+    # Calculate the recall for each class
+    recall = np.diag(confusion_matrix_norm) / np.sum(confusion_matrix_norm, axis=1)
+    # Calculate the precision for each class
+    precision = np.diag(confusion_matrix_norm) / np.sum(confusion_matrix_norm, axis=0)
+    # From teh recall and precision, calculate the F1 score
+    f1 = 2 * (precision * recall) / (precision + recall)
+    # calculate the class frequency
+    class_frequency = np.sum(confusion_matrix_norm, axis=1) / np.sum(confusion_matrix_norm)
+    # calculate the weighted accuracy
+    weighted_accuracy = np.sum(accuracy * class_frequency)
+    # calculate the weighted F1 score (micro)
+    weighted_f1 = np.sum(f1 * class_frequency)
+
+    return {
+        "num_samples": num_samples,
+        "confusion_matrix_counts": confusion_matrix,
+        "confusion_matrix": confusion_matrix_norm,
+        "brier_score_raw": brier_score_raw,
+        "uncertainty": uncertainty,
+        "mcc": mcc,
+        "accuracy": accuracy,
+        "recall": recall,
+        "precision": precision,
+        "f1": f1,
+        "weighted_accuracy": weighted_accuracy,
+        "weighted_f1": weighted_f1,
+    }
+
+
+class MetricsAccumulator:
+    """
+    Incremental accumulator of the classification scores.
+
+    The accumulator keeps the confusion matrix (raw counts), the sum of the squared errors and the sum of the uncertainties,
+    so it can be updated chunk by chunk and merged with other accumulators (e.g. computed over different shards of the data)
+    before computing the final scores.
+    """
+
+    def __init__(self, num_classes, num_uncert=None):
+        """
+        Inputs:
+        - num_classes: number of classes C (number of target and predicted columns).
+        - num_uncert: number of uncertainty columns. If None, it is assumed to be C.
+        """
+        if num_uncert is None:
+            num_uncert = num_classes
+        self.num_classes = num_classes
+        self.num_samples = 0
+        self.confusion_matrix = np.zeros((num_classes, num_classes))
+        self.brier_sum = np.zeros(num_classes)
+        self.uncertainty_sum = np.zeros(num_uncert)
+
+    def update(self, targets, preds, uncert):
+        """
+        Accumulate a chunk of samples.
+
+        Inputs:
+        - targets: matrix of size N x C with the target (ground truth) values, where N is the number of samples in the chunk.
+        - preds: matrix of size N x C with the predicted values.
+        - uncert: matrix of size N x C with the uncertainty of the predictions.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        preds = np.asarray(preds, dtype=np.float64)
+        uncert = np.asarray(uncert, dtype=np.float64)
+
+        # Confusion matrix from the argmax (winner takes all) of the target and predicted values
+        target_label_index = targets.argmax(axis=1)
+        pred_label_index = preds.argmax(axis=1)
+        self.confusion_matrix += np.bincount(
+            target_label_index * self.num_classes + pred_label_index, minlength=self.num_classes * self.num_classes
+        ).reshape(self.num_classes, self.num_classes)
+
+        # TODO: Brier score, using the argmax (one-hot encoding) [ that seems to be only valid if using binary predictor, single class ]
+        # Brier score, using the raw values. This is the MSE between the target and predicted labels
+        self.brier_sum += np.sum((targets - preds) ** 2, axis=0)
+        # Accumulate the uncertainty
+        self.uncertainty_sum += np.sum(uncert, axis=0)
+        self.num_samples += len(targets)
+        return self
+
+    def merge(self, other):
+        """
+        Add the samples accumulated by another accumulator (with the same number of classes) to this one.
+        """
+        if other.confusion_matrix.shape != self.confusion_matrix.shape:
+            raise ValueError("Cannot merge accumulators with different number of classes")
+        self.confusion_matrix += other.confusion_matrix
+        self.brier_sum += other.brier_sum
+        self.uncertainty_sum += other.uncertainty_sum
+        self.num_samples += other.num_samples
+        return self
+
+    def finalize(self):
+        """
+        Compute the scores from the accumulated samples.
+
+        Outputs:
+        - scores: dictionary with the scores, see _scores_from_counts.
+        """
+        return _scores_from_counts(self.confusion_matrix.copy(), self.brier_sum, self.uncertainty_sum, self.num_samples)
+
+
+def calculate_scores(targets, preds, uncert):
+    """
+    Compute the classification scores with array operations over the whole set of samples.
+
+    Inputs:
+    - targets: matrix of size N x C with the target (ground truth) values, where N is the number of samples and C the number of classes.
+    - preds: matrix of size N x C with the predicted values.
+    - uncert: matrix of size N x C with the uncertainty of the predictions.
+
+    Outputs:
+    - scores: dictionary with the scores, see _scores_from_counts.
+    """
+    accumulator = MetricsAccumulator(np.shape(targets)[1], np.shape(uncert)[1])
+    accumulator.update(targets, preds, uncert)
+    return accumulator.finalize()
+
+
+def evaluate_file(filename, target_prefix="target_", pred_prefix="pred_", uncert_prefix="uncertainty_", chunksize=100000):
+    """
+    Compute the classification scores of a CSV file containing the predictions and targets.
+
+    Inputs:
+    - filename: path to the CSV file.
+    - target_prefix, pred_prefix, uncert_prefix: prefixes of the target, predicted and uncertainty columns.
+    - chunksize: number of rows read and processed at once.
+
+    Outputs:
+    - scores: dictionary with the scores, see _scores_from_counts.
+    - target_labels, pred_labels: names of the target and predicted columns.
+    - class_names: names of the classes (suffix of the target columns after the last underscore).
+    """
+    # Read only the header, the rows are read later on in chunks
+    columns = read_header(filename)
+
+    # the target (ground truth) labels are the columns starting with "target_"
+    # the predicted labels are the columns starting with "pred_"
+
+    # Get the target labels
+    target_labels = [col for col in columns if col.startswith(target_prefix)]
+    # From the target labels, get the class names. They are the labels after the last underscore _
+    class_names = [label.split("_")[-1] for label in target_labels]
+    # Get the predicted labels
+    pred_labels = [col for col in columns if col.startswith(pred_prefix)]
+    # Get the predicted labels
+    uncert_labels = [col for col in columns if col.startswith(uncert_prefix)]
+
+    # Accumulate the confusion matrix, Brier score (MSE between the target and predicted labels) and uncertainty over chunks of rows
+    # Only the target, predicted and uncertainty columns are parsed
+    accumulator = MetricsAccumulator(len(target_labels), len(uncert_labels))
+    for chunk in iter_table(
+        filename, chunksize, columns=target_labels + pred_labels + uncert_labels
+    ):
+        accumulator.update(
+            chunk[target_labels].to_numpy(), chunk[pred_labels].to_numpy(), chunk[uncert_labels].to_numpy()
+        )
+
+    # Calculate the derived scores
+    return accumulator.finalize(), target_labels, pred_labels, class_names
+
+
+def scores_table(filename, scores, class_names):
+    """
+    Build the summary table of the scores (single row) for an input file.
+
+    Inputs:
+    - filename: path to the input file. The table uses its basename, without the extension.
+    - scores: dictionary with the scores, see _scores_from_counts.
+    - class_names: names of the classes.
+
+    Outputs:
+    - df_scores: dataframe with one row: input_file, mF1, F1_*, MCC_*, brier_mse_*, brier_mse, uncertainty_*, mean_uncertainty, accuracy_*.
+    """
+    num_classes = len(class_names)
+    f1 = scores["f1"]
+    mcc = scores["mcc"]
+    brier_score_raw = scores["brier_score_raw"]
+    uncertainty = scores["uncertainty"]
+    accuracy = scores["accuracy"]
+
+    # Export a summary of the scores: Brier score and accuracy
+    # The output CSV will be parsed by a batch script to generate a summary of the scores for all the experiments
+    # Here is a sample of the output CSV file:
+    # input_file, brier_score_onehot, brier_score_raw_label_0, brier_score_raw_label_1, ..., accuracy_label_0, accuracy_label_1, ...
+    # valid_mean_20m_ae_L15m_h16_1841.csv, 0.0, 0.0, 0.0, ..., 1.0, 1.0, ...
+
+    # Prepare the information to be saved to CSV. Note that we need to add the input filename
+    # The input filename is the basename of the input file, without the extension
+    # Get the basename of the input file
+    input_file = os.path.basename(filename)
+    # Remove the extension
+    input_file = os.path.splitext(input_file)[0]
+
+    # Create a dataframe with the input filename and the Brier score one-shot. The Brier score raw is a vector, we need to add each element as a column
+
+    # Create the output dataframe, appending as columns the input filename and the Brier score one-hot
+    df_scores = pd.DataFrame([[input_file, scores["weighted_f1"]]])
+
+    # Add the target labels as columns
+    df_scores.columns = ["input_file", "mF1"]
+
+    for i in range(num_classes):
+        df_scores["F1_" + class_names[i]] = f1[i]
+
+    for i in range(num_classes):
+        df_scores["MCC_" + class_names[i]] = mcc[i]
+
+    # Add the Brier MSE raw value (each element is an individual column of the dataframe)
+    for i in range(num_classes):
+        df_scores["brier_mse_" + class_names[i]] = brier_score_raw[i]
+    df_scores["brier_mse"] = brier_score_raw.mean()
+
+    # Insert uncertainties per class, and mean uncertainty
+    for i in range(num_classes):
+        df_scores["uncertainty_" + class_names[i]] = uncertainty[i]
+    df_scores["mean_uncertainty"] = uncertainty.mean()
+
+    # Add the accuracy (each element is an individual column of the dataframe)
+    for i in range(num_classes):
+        df_scores["accuracy_" + class_names[i]] = accuracy[i]
+
+    return df_scores
+
+
+def _evaluate_batch_entry(task):
+    # Worker of the batch mode: evaluate one file and return its summary row (None if the file could not be evaluated)
+    filename, target_prefix, pred_prefix, uncert_prefix, chunksize = task
+    try:
+        scores, _, _, class_names = evaluate_file(filename, target_prefix, pred_prefix, uncert_prefix, chunksize)
+    except Exception as e:
+        print("Could not evaluate [" + filename + "]: " + str(e))
+        return None
+    return scores_table(filename, scores, class_names)
+
+
+def batch_input_files(batch):
+    """
+    List the input files of the batch mode.
+
+    Inputs:
+    - batch: directory (all the CSV files in it, except the _scores.csv and _confusion_matrix.csv outputs) or glob pattern.
+
+    Outputs:
+    - filenames: sorted list of paths.
+    """
+    if os.path.isdir(batch):
+        filenames = glob.glob(os.path.join(batch, "*.csv"))
+        filenames = [f for f in filenames if not f.endswith(("_scores.csv", "_confusion_matrix.csv"))]
+    else:
+        filenames = glob.glob(batch)
+    return sorted(filenames)
+
+
+def evaluate_batch(filenames, target_prefix="target_", pred_prefix="pred_", uncert_prefix="uncertainty_", chunksize=100000, workers=None):
+    """
+    Evaluate a list of CSV files concurrently and consolidate their scores.
+
+    Inputs:
+    - filenames: list of paths to the CSV files.
+    - target_prefix, pred_prefix, uncert_prefix: prefixes of the target, predicted and uncertainty columns.
+    - chunksize: number of rows read and processed at once.
+    - workers: number of worker processes. If None, the number of CPUs is used.
+
+    Outputs:
+    - df_scores: dataframe with one row per evaluated file (same columns as scores_table), in the order of filenames.
+    """
+    tasks = [(f, target_prefix, pred_prefix, uncert_prefix, chunksize) for f in filenames]
+    if workers == 1:
+        rows = [_evaluate_batch_entry(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            rows = pool.map(_evaluate_batch_entry, tasks, chunksize=1)
+    rows = [row for row in rows if row is not None]
+    if not rows:
+        return pd.DataFrame(columns=["input_file"])
+    return pd.concat(rows, ignore_index=True)
+
+
+def plot_confusion_matrix(confusion_matrix, class_names, filename, output_file, formats=("png", "svg"), show=False):
+    """
+    Plot the normalized confusion matrix and save it to image files.
+
+    matplotlib is only imported here, so the metrics-only path (--noplot, batch mode) does not pay for it.
+    Unless the plot has to be shown, the non-interactive Agg backend is used.
+
+    Inputs:
+    - confusion_matrix: normalized confusion matrix of size C x C.
+    - class_names: names of the classes.
+    - filename: name of the input file, used in the title.
+    - output_file: output path prefix, the extension of each format is appended to it.
+    - formats: list of image formats to save (e.g. png, svg, pdf).
+    - show: flag to show the plot.
+    """
+    import matplotlib
+
+    if not show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # Generate a figure to plot the confusion matrix
+    fig = plt.figure()
+    # define the plot siz to be full width of the page
+    fig.set_size_inches(12, 8)
+    ax = fig.add_subplot(111)
+    # Plot the confusion matrix
+    cax = ax.matshow(confusion_matrix, cmap=plt.cm.inferno)
+    # Print the confusion matrix values in the plot
+    for (i, j), z in np.ndenumerate(confusion_matrix):
+        ax.text(j, i, "{:0.2f}".format(z), ha="center", va="center", color="white")
+
+    # set the colorbar, and the ticks values every 0.25
+    fig.colorbar(cax, ticks=[0, 0.25, 0.5, 0.75, 1])
+    # set the colorbar limits to 0.0 and 1.0
+    cax.set_clim(0.0, 1.0)
+
+    # Set the labels for the x-axis
+    ax.set_xticklabels(["pred_"] + class_names)
+    # Set the labels for the y-axis
+    ax.set_yticklabels(["target_"] + class_names)
+    # Rotate the labels for the x-axis
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="left", rotation_mode="anchor")
+    # Set the title
+    # plt.title('Confusion matrix')
+    plt.title("Confusion matrix for " + filename)
+    # Add subtitle with the Brier scores
+    # plt.suptitle('Brier score (one-hot):' + str(brier_score_onehot) + '\n Brier score (raw): ' + str(brier_score_raw) + '\n Confusion matrix raw:' + str(confusion_matrix_raw))
+    # Set the x-axis label
+    plt.xlabel("Target")
+    # Set the y-axis label
+    plt.ylabel("Predicted")
+    # Check if we want to show the plot
+    if show:
+        plt.show()
+
+    # Save the figure in each of the requested formats
+    for fmt in formats:
+        fig.savefig(output_file + "." + fmt, bbox_inches="tight")
+    plt.close(fig)
+
 
 def main(args=None):
     parser = argparse.ArgumentParser(
         description="Calculate and plot the confusion matrix from a CSV file containing the predictions and targets"
     )
-    parser.add_argument(
+    # A single input file, or a batch of input files, must be provided
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
         "--input",
         "-i",
         type=str,
-        required=True,
-        help="Path to the input CSV file with the predictions and targets",
+        help="Path to the input CSV file with the predictions and targets (Parquet and Feather files are also accepted)",
+    )
+    inputs.add_argument(
+        "--batch",
+        "-b",
+        type=str,
+        help="Directory or glob pattern (quoted) with the input CSV files to be evaluated in batch mode. The scores of all the files are consolidated in a single CSV file (one row per input file)",
     )
     # Output filename is optional
     parser.add_argument(
@@ -25,7 +409,7 @@ def main(args=None):
         "-o",
         type=str,
         default=None,
-        help="Path to the output file with the confusion matrix image",
+        help="Path to the output file with the confusion matrix image. In batch mode, path to the consolidated scores CSV file (default: batch_scores.csv)",
     )
     # Add option to define target labels, default target_
     parser.add_argument(
@@ -65,7 +449,47 @@ def main(args=None):
         action="store_true",
         help="Flag to disable generation and saving plots",
     )
-    args = parser.parse_args()
+    # Image formats of the confusion matrix plot
+    parser.add_argument(
+        "--format",
+        "-f",
+        type=str,
+        nargs="+",
+        default=["png", "svg"],
+        help="Image formats used to save the confusion matrix plot (default: png svg). Use e.g. '--format png' to skip the slower SVG rendering",
+    )
+    # Number of rows read at once, the metrics are accumulated chunk by chunk so memory does not grow with the file size
+    parser.add_argument(
+        "--chunksize",
+        "-c",
+        type=int,
+        default=100000,
+        help="Number of rows of the input CSV file read and processed at once",
+    )
+    # Number of worker processes for the batch mode
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Number of worker processes used in batch mode (default: number of CPUs)",
+    )
+    args = parser.parse_args(args)
+
+    # Batch mode: evaluate all the input files concurrently and export a single table with their scores
+    if args.batch is not None:
+        filenames = batch_input_files(args.batch)
+        if not filenames:
+            print("No input files found for batch: [" + args.batch + "]")
+            exit()
+        print("Evaluating " + str(len(filenames)) + " input files in batch mode")
+        df_scores = evaluate_batch(
+            filenames, args.target, args.pred, args.uncert, args.chunksize, args.workers
+        )
+        output_file = args.output if args.output is not None else "batch_scores.csv"
+        print("Exporting scores for " + str(len(df_scores)) + " input files to: ", output_file)
+        df_scores.to_csv(output_file)
+        return
 
     # Read CSV file
     # Check if the input file exists
@@ -77,97 +501,34 @@ def main(args=None):
         print("Provided input file: [" + args.input + "] not found.")
         exit()
     filename = args.input
-    df = pd.read_csv(filename)
-
-    # the target (ground truth) labels are the columns starting with "target_"
-    # the predicted labels are the columns starting with "pred_"
 
-    # Get the target labels
-    target_labels = [col for col in df.columns if col.startswith(args.target)]
-    # From the target labels, get the class names. They are the labels after the last underscore _
-    class_names = [label.split("_")[-1] for label in target_labels]
-    # Get the predicted labels
-    pred_labels = [col for col in df.columns if col.startswith(args.pred)]
-    # Get the predicted labels
-    uncert_labels = [col for col in df.columns if col.startswith(args.uncert)]
+    # Accumulate the confusion matrix, Brier score (MSE between the target and predicted labels) and uncertainty, and derive the scores
+    scores, target_labels, pred_labels, class_names = evaluate_file(
+        filename, args.target, args.pred, args.uncert, args.chunksize
+    )
     # Get the number of classes
     num_classes = len(target_labels)
     print("Number of classes: ", num_classes)
     print("Class names: ", class_names)
     # Get the number of samples
-    num_samples = len(df)
-    print("Number of samples (rows): ", num_samples)
-
-    # We want to create a confusion matrix of size num_classes x num_classes
-    # Initialize the confusion matrix
-    confusion_matrix = np.zeros((num_classes, num_classes))
-    # We also calculate the confusion_matrix using the raw values (not argmax)
-    # This is useful for the Brier score
-    confusion_matrix_raw = np.zeros((num_classes, num_classes))
-
-    # We also want to calculate the Brier score (MSE between the target and predicted labels)
-    # We have one Brier score for one-hot (argmax) encoding and one for the raw values
-    # brier_score_onehot = 0.0
-    brier_score_raw = 0.0
-    uncertainty = 0.0
-
-    # Iterate over the samples
-    for i in range(num_samples):
-        target_label_index = df.iloc[i][target_labels].to_numpy().argmax()
-        # Get the predicted label, in one-hot encoding winner takes all reduction of predicted probabilities
-        pred_label_index = df.iloc[i][pred_labels].to_numpy().argmax()
-        # Update the confusion matrix
-        confusion_matrix[target_label_index, pred_label_index] += 1
+    print("Number of samples (rows): ", scores["num_samples"])
 
-        # TODO: Brier score, using the argmax (one-hot encoding) [ that seems to be only valid if using binary predictor, single class ]
-        # Update the Brier score, using the raw values. This is the MSE between the target and predicted labels
-        brier_score_raw += (
-            df.iloc[i][target_labels].to_numpy() - df.iloc[i][pred_labels].to_numpy()
-        ) ** 2
-
-        # Accumulate the uncertainty
-        uncertainty += df.iloc[i][uncert_labels].to_numpy()
+    confusion_matrix = scores["confusion_matrix"]
+    brier_score_raw = scores["brier_score_raw"]
+    uncertainty = scores["uncertainty"]
+    mcc = scores["mcc"]
+    accuracy = scores["accuracy"]
+    f1 = scores["f1"]
+    weighted_f1 = scores["weighted_f1"]
 
     print("Confusion matrix:")
-    print(confusion_matrix)
+    print(scores["confusion_matrix_counts"])
     # Print the Brier score
-    brier_score_raw /= num_samples
     print("Brier score (raw-MSE):\t\t", brier_score_raw)
-    # Normalize and then print the uncertainty
-    uncertainty /= num_samples
+    # Print the normalized uncertainty
     print("Uncertainty:\t\t", uncertainty)
-
-    # Calculate each component TP, TN, FP, FN
-    TP = np.diag(confusion_matrix)
-    TN = np.sum(confusion_matrix) - (
-        np.sum(confusion_matrix, axis=0) + np.sum(confusion_matrix, axis=1) - TP
-    )
-    FP = np.sum(confusion_matrix, axis=0) - TP
-    FN = np.sum(confusion_matrix, axis=1) - TP
-
-    # Normalize the confusion matrices (normalizing before or after calculating the components does not change the results)
-    confusion_matrix = confusion_matrix / confusion_matrix.sum(axis=1)[:, np.newaxis]
-    mcc = (TP * TN - FP * FN) / np.sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
     print("MCC:\t\t", mcc)
 
-    # Calculate the accuracy for each class from the confusion matrix
-    accuracy = np.diag(confusion_matrix)
-    # Calculate the recall for each class
-    recall = np.diag(confusion_matrix) / np.sum(confusion_matrix, axis=1)
-    # Calculate the precision for each class
-    precision = np.diag(confusion_matrix) / np.sum(confusion_matrix, axis=0)
-    # print("Precision:\t\t", precision)
-    # From teh recall and precision, calculate the F1 score
-    f1 = 2 * (precision * recall) / (precision + recall)
-    # calculate the class frequency
-    class_frequency = np.sum(confusion_matrix, axis=1) / np.sum(confusion_matrix)
-    # calculate the weighted accuracy
-    weighted_accuracy = np.sum(accuracy * class_frequency)
-    # calculate the weighted F1 score (micro)
-    weighted_f1 = np.sum(f1 * class_frequency)
-    # Calculate the Matthews Correlation Coefficient (MCC)
-    # MCC = (TP * TN - FP * FN) / sqrt((TP + FP) * (TP + FN) * (TN + FP) * (TN + FN))
-
     # Print the accuracy for each class
     for i in range(num_classes):
         print("Accuracy for class ", class_names[i], ":\t", accuracy[i])
@@ -190,46 +551,7 @@ def main(args=None):
 
     # Check if plotting is disabled
     if args.noplot is not True:
-        # Generate a figure to plot the confusion matrix
-        fig = plt.figure()
-        # define the plot siz to be full width of the page
-        fig.set_size_inches(12, 8)
-        ax = fig.add_subplot(111)
-        # Plot the confusion matrix
-        cax = ax.matshow(confusion_matrix, cmap=plt.cm.inferno)
-        # Print the confusion matrix values in the plot
-        for (i, j), z in np.ndenumerate(confusion_matrix):
-            ax.text(j, i, "{:0.2f}".format(z), ha="center", va="center", color="white")
-
-        # set the colorbar, and the ticks values every 0.25
-        fig.colorbar(cax, ticks=[0, 0.25, 0.5, 0.75, 1])
-        # set the colorbar limits to 0.0 and 1.0
-        cax.set_clim(0.0, 1.0)
-
-        # Set the labels for the x-axis
-        ax.set_xticklabels(["pred_"] + class_names)
-        # Set the labels for the y-axis
-        ax.set_yticklabels(["target_"] + class_names)
-        # Rotate the labels for the x-axis
-        plt.setp(ax.get_xticklabels(), rotation=45, ha="left", rotation_mode="anchor")
-        # Set the title
-        # plt.title('Confusion matrix')
-        plt.title("Confusion matrix for " + filename)
-        # Add subtitle with the Brier scores
-        # plt.suptitle('Brier score (one-hot):' + str(brier_score_onehot) + '\n Brier score (raw): ' + str(brier_score_raw) + '\n Confusion matrix raw:' + str(confusion_matrix_raw))
-        # Set the x-axis label
-        plt.xlabel("Target")
-        # Set the y-axis label
-        plt.ylabel("Predicted")
-        # Check if we want to show the plot
-        if args.show:
-            plt.show()
-        # Save the figure
-
-        # save as PNG
-        fig.savefig(output_file + ".png", bbox_inches="tight")
-        # save as SVG
-        fig.savefig(output_file + ".svg", bbox_inches="tight")
+        plot_confusion_matrix(confusion_matrix, class_names, filename, output_file, args.format, args.show)
 
     print("------------------------")
     print("Exporting confusion matrix and scores to CSV")
@@ -244,45 +566,7 @@ def main(args=None):
     df_confusion_matrix.to_csv(output_file + "_confusion_matrix.csv")
 
     # Export a summary of the scores: Brier score and accuracy
-    # The output CSV will be parsed by a batch script to generate a summary of the scores for all the experiments
-    # Here is a sample of the output CSV file:
-    # input_file, brier_score_onehot, brier_score_raw_label_0, brier_score_raw_label_1, ..., accuracy_label_0, accuracy_label_1, ...
-    # valid_mean_20m_ae_L15m_h16_1841.csv, 0.0, 0.0, 0.0, ..., 1.0, 1.0, ...
-
-    # Prepare the information to be saved to CSV. Note that we need to add the input filename
-    # The input filename is the basename of the input file, without the extension
-    # Get the basename of the input file
-    input_file = os.path.basename(filename)
-    # Remove the extension
-    input_file = os.path.splitext(input_file)[0]
-
-    # Create a dataframe with the input filename and the Brier score one-shot. The Brier score raw is a vector, we need to add each element as a column
-
-    # Create the output dataframe, appending as columns the input filename and the Brier score one-hot
-    df_scores = pd.DataFrame([[input_file, weighted_f1]])
-
-    # Add the target labels as columns
-    df_scores.columns = ["input_file", "mF1"]
-
-    for i in range(num_classes):
-        df_scores["F1_" + class_names[i]] = f1[i]
-
-    for i in range(num_classes):
-        df_scores["MCC_" + class_names[i]] = mcc[i]
-
-    # Add the Brier MSE raw value (each element is an individual column of the dataframe)
-    for i in range(num_classes):
-        df_scores["brier_mse_" + class_names[i]] = brier_score_raw[i]
-    df_scores["brier_mse"] = brier_score_raw.mean()
-
-    # Insert uncertainties per class, and mean uncertainty
-    for i in range(num_classes):
-        df_scores["uncertainty_" + class_names[i]] = uncertainty[i]
-    df_scores["mean_uncertainty"] = uncertainty.mean()
-
-    # Add the accuracy (each element is an individual column of the dataframe)
-    for i in range(num_classes):
-        df_scores["accuracy_" + class_names[i]] = accuracy[i]
+    df_scores = scores_table(filename, scores, class_names)
 
     # Save the dataframe to CSV
     df_scores.to_csv(output_file + "_scores.csv")
@@ -0,0 +1,216 @@
+# geo.py
+
+# Description: Shared georeferencing functions of the latent toolbox. Latitude and longitude (WGS84, degrees) are projected to UTM
+# coordinates (northing, easting, in metres) row by row:
+#   - The UTM zone and hemisphere are computed for each entry, so datasets crossing a zone boundary (or the equator) are projected
+#     with the zone of each entry instead of the zone of the first one.
+#   - Entries are grouped by zone and each group is projected with a single (vectorized) call. Single zone datasets are projected
+#     with one call, as before.
+#   - The pyproj Transformer of each zone is created once and cached, so projecting chunk after chunk does not rebuild it.
+# A zone can also be forced for all the entries (e.g. to keep a survey crossing a zone boundary in a single continuous grid).
+# The inverse transform (UTM to latitude and longitude) and helpers to append the UTM columns to a dataframe (e.g. a layer that only
+# has latitude and longitude) are also provided.
+
+import functools
+
+import numpy as np
+import pyproj
+
+# Names of the georeferencing columns used across the toolbox
+LATITUDE_COLUMN = 'latitude [deg]'
+LONGITUDE_COLUMN = 'longitude [deg]'
+NORTHING_COLUMN = 'northing_utm [m]'
+EASTING_COLUMN = 'easting_utm [m]'
+
+# EPSG codes of the WGS84 geographic coordinates and of the WGS84 / UTM zones (zone number is added)
+WGS84_EPSG = 4326
+UTM_NORTH_EPSG = 32600
+UTM_SOUTH_EPSG = 32700
+
+
+def utm_zone(lon):
+    """
+    UTM zone (1 to 60) of each longitude (degrees). NaN longitudes get zone 0.
+    """
+    # Longitudes are wrapped to [-180, 180), so 180 deg falls in zone 1
+    zone = np.floor_divide(np.mod(np.asarray(lon, dtype=np.float64) + 180, 360), 6) + 1
+    return np.where(np.isfinite(zone), zone, 0).astype(np.int64)
+
+
+def parse_zone(zone):
+    """
+    Parse a UTM zone given as text: '30' or '30N' (north), '30S' (south).
+
+    Outputs:
+    - zone: zone number (1 to 60).
+    - south: True for the southern hemisphere.
+    """
+    text = str(zone).strip().upper()
+    south = text.endswith('S')
+    if text[-1:] in ['N', 'S']:
+        text = text[:-1]
+    try:
+        number = int(text)
+    except ValueError:
+        raise ValueError("Invalid UTM zone: " + str(zone) + ". Expected a zone number (1 to 60), optionally followed by N or S (e.g. 30N)")
+    if number < 1 or number > 60:
+        raise ValueError("Invalid UTM zone: " + str(zone) + ". The zone number must be between 1 and 60")
+    return number, south
+
+
+def utm_epsg(zone, south=False):
+    """
+    EPSG code of the WGS84 / UTM projection of a zone (e.g. 32630 for zone 30N, 32730 for zone 30S).
+    """
+    return (UTM_SOUTH_EPSG if south else UTM_NORTH_EPSG) + int(zone)
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(epsg_from, epsg_to):
+    """
+    Transformer between two coordinate systems given by their EPSG codes. Transformers are created once and cached.
+    The axis order is always (x, y), i.e. (longitude, latitude) and (easting, northing).
+    """
+    return pyproj.Transformer.from_crs(epsg_from, epsg_to, always_xy=True)
+
+
+def latlon_to_utm(lat, lon, zone=None):
+    """
+    Project latitude and longitude (WGS84, degrees) to UTM coordinates.
+
+    Inputs:
+    - lat, lon: arrays of latitudes and longitudes.
+    - zone: UTM zone used for all the entries, as a number or text (e.g. 30, '30N', '30S'). If None, the zone and hemisphere of each
+      entry are given by its own longitude and latitude.
+
+    Outputs:
+    - northing, easting: arrays of UTM coordinates (float64). Entries with NaN latitude or longitude are NaN.
+    - epsg: array with the EPSG code of the UTM zone of each entry (0 for NaN entries).
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+
+    if zone is not None:
+        number, south = parse_zone(zone)
+        epsg = np.where(valid, utm_epsg(number, south), 0)
+    elif len(lat) > 0 and valid.all() and utm_zone(lon.min()) == utm_zone(lon.max()) and (lat.min() >= 0 or lat.max() < 0):
+        # All the entries are in the same zone and hemisphere (the usual case), no need to find the zone of each entry
+        epsg = np.full(lat.shape, utm_epsg(utm_zone(lon[0]), lat[0] < 0))
+    else:
+        epsg = np.where(valid, np.where(lat < 0, UTM_SOUTH_EPSG, UTM_NORTH_EPSG) + utm_zone(lon), 0)
+
+    if len(epsg) > 0 and epsg[0] != 0 and (epsg == epsg[0]).all():
+        # Single zone: one call for all the entries
+        easting, northing = get_transformer(WGS84_EPSG, int(epsg[0])).transform(lon, lat)
+        return np.asarray(northing, dtype=np.float64), np.asarray(easting, dtype=np.float64), epsg
+    # Several zones (or NaN entries): one call per zone
+    northing = np.full(lat.shape, np.nan)
+    easting = np.full(lat.shape, np.nan)
+    for code in np.unique(epsg[valid]):
+        rows = np.flatnonzero(epsg == code)
+        easting[rows], northing[rows] = get_transformer(WGS84_EPSG, int(code)).transform(lon[rows], lat[rows])
+    return northing, easting, epsg
+
+
+def utm_to_latlon(northing, easting, zone):
+    """
+    Unproject UTM coordinates to latitude and longitude (WGS84, degrees).
+
+    Inputs:
+    - northing, easting: arrays of UTM coordinates (metres).
+    - zone: UTM zone of the entries, either a single zone as a number or text (e.g. 30, '30N', '30S') or an array with the EPSG code
+      of each entry, as returned by latlon_to_utm (0 for NaN entries).
+
+    Outputs:
+    - lat, lon: arrays of latitudes and longitudes (float64). Entries with NaN coordinates (or EPSG 0) are NaN.
+    """
+    northing = np.asarray(northing, dtype=np.float64)
+    easting = np.asarray(easting, dtype=np.float64)
+    valid = np.isfinite(northing) & np.isfinite(easting)
+    if np.ndim(zone) == 0:
+        number, south = parse_zone(zone)
+        epsg = np.where(valid, utm_epsg(number, south), 0)
+    else:
+        epsg = np.where(valid, np.asarray(zone, dtype=np.int64), 0)
+
+    if len(epsg) > 0 and epsg[0] != 0 and (epsg == epsg[0]).all():
+        # Single zone: one call for all the entries
+        lon, lat = get_transformer(int(epsg[0]), WGS84_EPSG).transform(easting, northing)
+        return np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    # Several zones (or NaN entries): one call per zone
+    lat = np.full(northing.shape, np.nan)
+    lon = np.full(northing.shape, np.nan)
+    for code in np.unique(epsg[epsg != 0]):
+        rows = np.flatnonzero(epsg == code)
+        lon[rows], lat[rows] = get_transformer(int(code), WGS84_EPSG).transform(easting[rows], northing[rows])
+    return lat, lon
+
+
+def central_zone(lat, lon):
+    """
+    UTM zone (text, e.g. '30N') of the centre of a set of entries (mean latitude and longitude, NaN entries are ignored).
+    Used to project several layers that must be compared (e.g. by distance) into the same UTM zone.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    valid = np.isfinite(lat) & np.isfinite(lon)
+    if not valid.any():
+        raise ValueError("No valid latitude and longitude values to determine the UTM zone")
+    return str(int(utm_zone(lon[valid].mean()))) + ('S' if lat[valid].mean() < 0 else 'N')
+
+
+def add_utm_columns(df, zone=None):
+    """
+    Append (or overwrite) the UTM columns 'northing_utm [m]' and 'easting_utm [m]' of a dataframe from its 'latitude [deg]' and
+    'longitude [deg]' columns. The dataframe is modified in place.
+
+    Inputs:
+    - df: dataframe with the latitude and longitude columns.
+    - zone: UTM zone used for all the entries (see latlon_to_utm). If None, the zone of each entry is used.
+
+    Outputs:
+    - counts: number of entries per UTM zone (see zone_counts).
+    """
+    northing, easting, epsg = latlon_to_utm(df[LATITUDE_COLUMN].to_numpy(dtype=np.float64),
+                                            df[LONGITUDE_COLUMN].to_numpy(dtype=np.float64), zone)
+    df[NORTHING_COLUMN] = northing
+    df[EASTING_COLUMN] = easting
+    return zone_counts(epsg)
+
+
+def has_utm(columns):
+    """True if the columns include both UTM coordinates."""
+    return NORTHING_COLUMN in columns and EASTING_COLUMN in columns
+
+
+def has_latlon(columns):
+    """True if the columns include both latitude and longitude."""
+    return LATITUDE_COLUMN in columns and LONGITUDE_COLUMN in columns
+
+
+def zone_name(epsg):
+    """
+    Name of the UTM zone of an EPSG code (e.g. '30N' for 32630).
+    """
+    epsg = int(epsg)
+    if UTM_SOUTH_EPSG < epsg <= UTM_SOUTH_EPSG + 60:
+        return str(epsg - UTM_SOUTH_EPSG) + 'S'
+    return str(epsg - UTM_NORTH_EPSG) + 'N'
+
+
+def zone_counts(epsg):
+    """
+    Number of entries per UTM zone, as a dictionary {EPSG code: count}. NaN entries (EPSG 0) are not counted.
+    """
+    codes, counts = np.unique(np.asarray(epsg), return_counts=True)
+    return {int(code): int(count) for code, count in zip(codes, counts) if code != 0}
+
+
+def report_zones(counts):
+    """
+    Print the UTM zones of the entries (see zone_counts), warning when they span several zones.
+    """
+    print ('UTM zone(s): ' + ', '.join(zone_name(code) + ' (' + str(counts[code]) + ' entries)' for code in sorted(counts)))
+    if len(counts) > 1:
+        print ('Warning: the entries span several UTM zones. Coordinates of different zones are not continuous, use --zone to project all the entries in a single zone.')
@@ -2,46 +2,342 @@ import argparse
 import numpy as np
 import pandas as pd
 import os
+import bz2
+import glob
+import gzip
+import lzma
+import multiprocessing
+import shutil
+import tempfile
+import zipfile
+
+from latent_io import load_latents, latent_columns, table_format, TableWriter
+
+# Compression of the CSV output, selected with --compression or inferred from the extension of the output file
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zstd': '.zst'}
+
+
+def infer_compression(path):
+    # Compression from the extension of the output file (e.g. latents.csv.gz), None for uncompressed files
+    for compression, ext in COMPRESSION_EXTENSIONS.items():
+        if path.lower().endswith(ext):
+            return compression
+    return None
+
+
+def open_output(path, compression=None):
+    """
+    Open a text file for writing, compressing it on the fly.
+
+    Inputs:
+    - path: path to the output file.
+    - compression: None, 'gzip', 'bz2', 'xz' or 'zstd' (requires the zstandard package).
+
+    Outputs:
+    - handle: file object opened in text mode.
+    """
+    if compression is None:
+        return open(path, 'w', newline='')
+    elif compression == 'gzip':
+        return gzip.open(path, 'wt', newline='')
+    elif compression == 'bz2':
+        return bz2.open(path, 'wt', newline='')
+    elif compression == 'xz':
+        return lzma.open(path, 'wt', newline='')
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd compression requires the zstandard package (pip install zstandard)")
+        return zstandard.open(path, 'wt', newline='')
+    raise ValueError("Unknown compression: " + str(compression) + ". Options are: " + ", ".join(COMPRESSION_EXTENSIONS))
+
+
+def write_latents(handle, latents, chunksize=100000, float_format=None, id_column=None, start_id=0, header=True):
+    """
+    Write a block of latents as CSV rows, chunk by chunk.
+
+    Inputs:
+    - handle: file object (text mode) where the rows are written.
+    - latents: 2-D array of latents (rows are entries). It can be a memory mapped array, only one chunk is loaded at a time.
+    - chunksize: number of rows written at once.
+    - float_format: format string of the latent values (e.g. '%.6g'). If None, the shortest exact representation is used.
+    - id_column: name of the id column prepended to the latents. If None, no id column is written.
+    - start_id: id of the first row.
+    - header: flag to write the header line.
+
+    Outputs:
+    - rows: number of rows written.
+    """
+    columns = latent_columns(latents.shape[1])
+    if header:
+        pd.DataFrame(columns=([id_column] if id_column is not None else []) + columns).to_csv(handle, index=False)
+
+    for start in range(0, latents.shape[0], chunksize):
+        df = pd.DataFrame(latents[start:start + chunksize], columns=columns, copy=False)
+        if id_column is not None:
+            df.insert(0, id_column, np.arange(start_id + start, start_id + start + len(df)))
+        df.to_csv(handle, header=False, index=False, float_format=float_format)
+    return latents.shape[0]
+
+
+def expand_inputs(patterns):
+    """
+    Expand the list of input paths and glob patterns (e.g. 'latents/dive_*.npy') into a list of files.
+    Each pattern is expanded in sorted order, and the patterns keep the order in which they were provided.
+
+    Outputs:
+    - files: list of paths. Patterns that do not match any file are returned in missing.
+    - missing: list of patterns (or paths) that do not match any file.
+    """
+    files = []
+    missing = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else ([pattern] if os.path.isfile(pattern) else [])
+        if len(matches) == 0:
+            missing.append(pattern)
+        files.extend(matches)
+    return files, missing
+
+
+def _npz_shapes(path):
+    # Shapes of the arrays stored in a .npz archive, read from the array headers without loading the arrays
+    shapes = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if not name.endswith('.npy'):
+                continue
+            with archive.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape = np.lib.format.read_array_header_1_0(f)[0]
+                else:
+                    shape = np.lib.format.read_array_header_2_0(f)[0]
+            shapes[name[:-len('.npy')]] = shape
+    return shapes
+
+
+def list_shards(files, arrays=None):
+    """
+    List the shards (blocks of latents) contained in the input files.
+    Each .npy file is a shard, and each named array of a .npz archive is a shard (only the arrays listed in arrays, if provided).
+
+    Inputs:
+    - files: list of .npy / .npz files.
+    - arrays: names of the arrays read from .npz archives. If None, all the arrays of the archive are read, in archive order.
+
+    Outputs:
+    - shards: list of (path, array name or None, number of rows, latent dimensions).
+    """
+    shards = []
+    for path in files:
+        if path.lower().endswith('.npz'):
+            shapes = _npz_shapes(path)
+            names = list(shapes) if arrays is None else arrays
+            for name in names:
+                if name not in shapes:
+                    raise KeyError("Array [" + name + "] not found in [" + path + "]. Available arrays: " + ", ".join(shapes))
+                # Arrays with more than 2 dimensions are flattened per entry (see load_shard)
+                shape = shapes[name]
+                shards.append((path, name, shape[0] if len(shape) > 0 else 1, int(np.prod(shape[1:]))))
+        else:
+            shape = load_latents(path).shape
+            shards.append((path, None, shape[0], shape[1]))
+    return shards
+
+
+def load_shard(path, array=None):
+    """
+    Load a shard of latents as a 2-D array. Arrays of .npy files are memory mapped, arrays of .npz archives are loaded.
+    Arrays with more than 2 dimensions are flattened per entry (rows x product of the other dimensions), as in load_latents.
+    """
+    if array is None:
+        return load_latents(path)
+    with np.load(path) as archive:
+        latents = archive[array]
+    return latents.reshape(len(latents) if latents.ndim > 0 else 1, -1) if latents.ndim != 2 else latents
+
+
+def shard_output(path, array, output_dir=None, extension='.csv'):
+    # Output file of a shard when each shard is exported to its own file: input name (plus the array name for .npz archives)
+    name = os.path.splitext(os.path.basename(path))[0]
+    if array is not None:
+        name += '_' + array
+    folder = output_dir if output_dir is not None else os.path.dirname(path)
+    return os.path.join(folder, name + extension)
+
+
+def convert_shard(task):
+    """
+    Export a shard to a CSV (optionally compressed) or binary table. Used by the worker pool, a single tuple is received.
+
+    Inputs (task):
+    - path, array: shard to export (see load_shard).
+    - output_file: path to the output file.
+    - compression: compression of the CSV output (see open_output).
+    - chunksize, float_format, id_column, start_id, header: see write_latents.
+
+    Outputs:
+    - rows: number of rows written.
+    """
+    path, array, output_file, compression, chunksize, float_format, id_column, start_id, header = task
+    latents = load_shard(path, array)
+    if table_format(output_file) != 'csv':
+        # Binary outputs (Parquet, Feather) keep the latent values and type, the CSV options do not apply
+        with TableWriter(output_file) as writer:
+            write_frames(writer, latents, chunksize, id_column, start_id)
+        return latents.shape[0]
+    with open_output(output_file, compression) as handle:
+        return write_latents(handle, latents, chunksize, float_format, id_column, start_id, header)
+
+
+def write_frames(writer, latents, chunksize=100000, id_column=None, start_id=0):
+    # Write a block of latents to a TableWriter, chunk by chunk (an empty block still writes the columns)
+    columns = latent_columns(latents.shape[1])
+    for start in range(0, max(latents.shape[0], 1), chunksize):
+        df = pd.DataFrame(latents[start:start + chunksize], columns=columns, copy=False)
+        if id_column is not None:
+            df.insert(0, id_column, np.arange(start_id + start, start_id + start + len(df)))
+        writer.write(df)
+
+
+def concatenate_shards(tasks, output_file, workers):
+    """
+    Export the shards in parallel to temporary part files and concatenate them, in order, into the output file.
+    Compressed parts are concatenated as they are: gzip, bz2, xz and zstd streams can be concatenated into a single valid file.
+    """
+    folder = os.path.dirname(os.path.abspath(output_file))
+    parts = []
+    try:
+        for i in range(len(tasks)):
+            fd, part = tempfile.mkstemp(prefix=os.path.basename(output_file) + '.part' + str(i) + '.', dir=folder)
+            os.close(fd)
+            parts.append(part)
+        tasks = [(t[0], t[1], part) + t[3:] for t, part in zip(tasks, parts)]
+        with multiprocessing.Pool(workers) as pool:
+            rows = pool.map(convert_shard, tasks, chunksize=1)
+        with open(output_file, 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+    finally:
+        for part in parts:
+            if os.path.isfile(part):
+                os.remove(part)
+    return sum(rows)
+
 
 def main(args=None):
     parser = argparse.ArgumentParser(description="Convert Numpy file containing latent representation to CSV file.")
-    parser.add_argument("--input", "-i", type=str, required=True, help="Path to the input Numpy file")
+    parser.add_argument("--input", "-i", type=str, nargs="+", required=True, help="Path to the input Numpy file(s). Several files or glob patterns (e.g. 'latents/*.npy') can be provided, as well as .npz archives")
     # Output filename is optional
-    parser.add_argument("--output", "-o", type=str, default=None, help="Path to the output CSV file")
-    args = parser.parse_args()
+    parser.add_argument("--output", "-o", type=str, default=None, help="Path to the output CSV file. Parquet and Feather outputs are selected by extension. With --split, the folder where the output files are written")
+    # Export options
+    parser.add_argument("--chunksize", "-c", type=int, default=100000, help="Number of rows converted and written at once (default: 100000)")
+    parser.add_argument("--float-format", "-f", type=str, default=None, help="Format of the latent values in the CSV file (e.g. '%%.6f'). Default: shortest exact representation")
+    parser.add_argument("--precision", "-p", type=int, default=None, help="Number of significant digits of the latent values in the CSV file. Shortcut for --float-format '%%.<precision>g'")
+    parser.add_argument("--id", type=str, nargs="?", const="id", default=None, help="Prepend an id column (row number) to the latents. Optionally, the name of the column (default: id)")
+    parser.add_argument("--compression", type=str, default=None, choices=list(COMPRESSION_EXTENSIONS), help="Compress the CSV output on the fly. Inferred from the output extension (.gz, .bz2, .xz, .zst) if not provided")
+    # Multiple inputs
+    parser.add_argument("--array", "-a", type=str, nargs="+", default=None, help="Names of the arrays read from .npz archives. Default: all the arrays of the archive")
+    parser.add_argument("--split", action="store_true", help="Export each shard (input file, or array of a .npz archive) to its own output file instead of a single concatenated file")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="Number of worker processes converting the shards in parallel (default: 1)")
+    args = parser.parse_args(args)
+
+    # Expand the input files and glob patterns
+    # If any of the inputs does not exist, the script will exit
+    input_files, missing = expand_inputs(args.input)
+    if len(missing) > 0:
+        print ("Provided input file(s): [" + ", ".join(missing) + "] not found.")
+        exit()
+
+    if args.chunksize < 1:
+        print ("The chunk size must be a positive integer.")
+        exit()
+    if args.workers < 1:
+        print ("The number of workers must be a positive integer.")
+        exit()
 
-    # Check if the input file exists
-    # If the file does not exist, the script will exit
     try:
-        with open(args.input, 'r') as f:
-            pass
-    except FileNotFoundError as e:
-        print ("Provided input file: [" + args.input + "] not found.")
+        shards = list_shards(input_files, args.array)
+    except KeyError as e:
+        print (e.args[0])
         exit()
+    if len(shards) == 0:
+        print ("No arrays found in the provided input file(s).")
+        exit()
+
+    # All the shards must have the same latent dimensions
+    dims = sorted(set(shard[3] for shard in shards))
+    if len(dims) > 1:
+        print ("The latent dimensions of the input shards do not agree:")
+        for path, array, rows, dim in shards:
+            print ("\t[" + path + "]" + ("[" + array + "]" if array is not None else "") + ": " + str(dim))
+        exit()
+    latents_dim = dims[0]
+    entries = sum(shard[2] for shard in shards)
+
+    print("Input shards:", len(shards))
+    print("Total entries:", entries)
+    print("Latents dimensions:", latents_dim)
+
+    float_format = args.float_format
+    if args.precision is not None:
+        float_format = "%." + str(args.precision) + "g"
 
-    input_file = args.input
+    # Ids are consecutive across the shards, in the order in which they are listed
+    start_ids = np.concatenate([[0], np.cumsum([shard[2] for shard in shards])[:-1]]).tolist()
 
-    # Check if output file has been provided - if not, then use the input filename with .csv extension
+    if args.split:
+        # One output per shard, written next to its input file or into the --output folder
+        if args.output is not None:
+            os.makedirs(args.output, exist_ok=True)
+        extension = '.csv' + (COMPRESSION_EXTENSIONS[args.compression] if args.compression is not None else '')
+        tasks = []
+        for (path, array, rows, dim), start_id in zip(shards, start_ids):
+            output_file = shard_output(path, array, args.output, extension)
+            if os.path.isfile(output_file):
+                print ('Output file [' + output_file + '] already exists. Overwriting...')
+            tasks.append((path, array, output_file, args.compression, args.chunksize, float_format, args.id, start_id, True))
+        if args.workers > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(min(args.workers, len(tasks))) as pool:
+                pool.map(convert_shard, tasks, chunksize=1)
+        else:
+            for task in tasks:
+                convert_shard(task)
+        for task in tasks:
+            print ("Saved to [", task[2], "] ...done!")
+        return
+
+    # Check if output file has been provided - if not, then use the (first) input filename with .csv extension (plus the compression extension)
     if args.output is None:
-        output_file = os.path.splitext(input_file)[0] + '.csv'
+        output_file = os.path.splitext(input_files[0])[0] + '.csv'
+        if args.compression is not None:
+            output_file += COMPRESSION_EXTENSIONS[args.compression]
     else:
         output_file = args.output
+    compression = args.compression if args.compression is not None else infer_compression(output_file)
 
     # Check if the output file exists, print a warning message and continue
     if os.path.isfile(output_file):
         print ('Provided output file [' + output_file + '] already exists. Overwriting...')
 
-    latents_np = np.load(input_file)
-    latents_dim = latents_np.shape[1]
-    entries = latents_np.shape[0]
-
-    print("Total entries:", entries)
-    print("Latents dimensions:", latents_dim)
-
-    header = ["latent_" + str(i) for i in range(latents_dim)]
-    df = pd.DataFrame(latents_np, columns=header)
-    df.to_csv(output_file, index=False)
+    if table_format(output_file) != 'csv':
+        # Binary outputs (Parquet, Feather) are written by a single writer, shard after shard
+        with TableWriter(output_file) as writer:
+            for (path, array, rows, dim), start_id in zip(shards, start_ids):
+                write_frames(writer, load_shard(path, array), args.chunksize, args.id, start_id)
+    elif args.workers > 1 and len(shards) > 1:
+        # The header is written by the first shard, the rest of the shards only append their rows
+        tasks = [(path, array, None, compression, args.chunksize, float_format, args.id, start_id, i == 0)
+                 for i, ((path, array, rows, dim), start_id) in enumerate(zip(shards, start_ids))]
+        concatenate_shards(tasks, output_file, min(args.workers, len(tasks)))
+    else:
+        # Memory map the inputs, the latents are only read chunk by chunk when they are exported
+        with open_output(output_file, compression) as handle:
+            for i, ((path, array, rows, dim), start_id) in enumerate(zip(shards, start_ids)):
+                write_latents(handle, load_shard(path, array), args.chunksize, float_format, args.id, start_id, header=(i == 0))
     print ("Saved to [", output_file, "] ...done!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
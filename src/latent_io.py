@@ -0,0 +1,296 @@
+# latent_io.py
+
+# Description: Shared I/O layer of the latent toolbox. Tables are read and written in the format given by the file extension:
+#   - CSV (default, any other extension, including compressed .csv.gz, .csv.bz2, ...): text, compatible with all the previous versions
+#   - Parquet (.parquet, .pq): binary columnar format, column types (e.g. float32 latents) are preserved
+#   - Feather (.feather, .arrow, .ipc): Arrow IPC file format, read through a memory map
+#   - NPY (.npy): numpy array of latents, read through a memory map. Columns are named latent_0, latent_1, ..., latent_n-1
+# Parquet and Feather require pyarrow, which is only imported when one of these formats is used.
+
+# The latents of NPY files stay as a single contiguous float32 block (a memory mapped view of the file, nothing is loaded
+# until it is used), and Parquet/Feather keep the float32 type of the latents when they were written from float32 data.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# Supported table formats, detected by extension
+TABLE_FORMATS = ['csv', 'parquet', 'feather', 'npy']
+
+# Prefix of the latent columns, used to name the columns of NPY files
+LATENT_PREFIX = 'latent_'
+
+# Size (bytes) reserved for the header of the NPY files written in chunks. The header is rewritten with the final number of rows when
+# the file is closed, so it needs room for any row count (the NPY format requires a multiple of 64 bytes)
+_NPY_HEADER_SIZE = 128
+
+
+def table_format(path):
+    """
+    Detect the format of a table from the extension of its path.
+
+    Outputs:
+    - format: one of 'csv', 'parquet', 'feather' or 'npy'. Unknown extensions are treated as CSV.
+    """
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext in ['.parquet', '.pq']:
+        return 'parquet'
+    elif ext in ['.feather', '.arrow', '.ipc']:
+        return 'feather'
+    elif ext == '.npy':
+        return 'npy'
+    return 'csv'
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Reading or writing Parquet/Feather files requires pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def latent_columns(n):
+    """Names of the columns of a block of n latents: latent_0, latent_1, ..., latent_n-1."""
+    return [LATENT_PREFIX + str(i) for i in range(n)]
+
+
+def load_latents(path):
+    """
+    Load a NPY file of latents as a memory mapped 2-D array (rows are entries, columns are latent dimensions).
+    Arrays with more than 2 dimensions are flattened per entry (rows x product of the other dimensions).
+    """
+    latents = np.load(path, mmap_mode='r')
+    if latents.ndim != 2:
+        latents = latents.reshape(len(latents) if latents.ndim > 0 else 1, -1)
+    return latents
+
+
+def _latents_frame(latents, columns=None, start=0):
+    # Wrap a block of latents in a dataframe without copying it (the block keeps its dtype, e.g. float32)
+    names = latent_columns(latents.shape[1])
+    df = pd.DataFrame(latents, columns=names, copy=False)
+    df.index = pd.RangeIndex(start, start + len(df))
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def read_header(path):
+    """
+    Read the column names of a table without loading its rows.
+
+    Outputs:
+    - columns: pandas Index with the column names.
+    """
+    fmt = table_format(path)
+    if fmt == 'parquet':
+        pa = _import_pyarrow()
+        return pd.Index(pa.parquet.read_schema(path).names)
+    elif fmt == 'feather':
+        pa = _import_pyarrow()
+        with pa.memory_map(path, 'r') as source:
+            return pd.Index(pa.ipc.open_file(source).schema.names)
+    elif fmt == 'npy':
+        return pd.Index(latent_columns(load_latents(path).shape[1]))
+    return pd.read_csv(path, nrows=0).columns
+
+
+def read_table(path, columns=None):
+    """
+    Read a table into a dataframe.
+
+    Inputs:
+    - path: path to the table, the format is given by its extension.
+    - columns: list of columns to read. If None, all the columns are read.
+
+    Outputs:
+    - df: dataframe.
+    """
+    fmt = table_format(path)
+    if fmt == 'parquet':
+        _import_pyarrow()
+        return pd.read_parquet(path, columns=columns)
+    elif fmt == 'feather':
+        _import_pyarrow()
+        return pd.read_feather(path, columns=columns)
+    elif fmt == 'npy':
+        return _latents_frame(load_latents(path), columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def iter_table(path, chunksize, columns=None, skiprows=0):
+    """
+    Read a table in chunks of rows.
+
+    Inputs:
+    - path: path to the table, the format is given by its extension.
+    - chunksize: number of rows per chunk.
+    - columns: list of columns to read. If None, all the columns are read.
+    - skiprows: number of rows (entries, not counting the header) skipped at the beginning of the table.
+
+    Outputs:
+    - iterator of dataframes with up to chunksize rows.
+    """
+    fmt = table_format(path)
+    if fmt == 'parquet':
+        pa = _import_pyarrow()
+        # Stream the record batches, skipping the first rows
+        skipped = 0
+        for batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            if skipped + batch.num_rows <= skiprows:
+                skipped += batch.num_rows
+                continue
+            batch = batch.slice(max(0, skiprows - skipped))
+            skipped = skiprows
+            yield batch.to_pandas()
+    elif fmt == 'feather':
+        pa = _import_pyarrow()
+        # The table is memory mapped, so slicing it only reads the rows of each chunk
+        table = pa.feather.read_table(path, columns=columns, memory_map=True)
+        for start in range(skiprows, table.num_rows, chunksize):
+            yield table.slice(start, chunksize).to_pandas()
+    elif fmt == 'npy':
+        latents = load_latents(path)
+        for start in range(skiprows, latents.shape[0], chunksize):
+            yield _latents_frame(latents[start:start + chunksize], columns, start)
+    else:
+        # The skipped rows are given as a function of the row number: pandas turns a list (or a count) of rows into a set of all
+        # the skipped row numbers, which takes hundreds of MB when resuming millions of rows into a file
+        skip = (lambda row: 0 < row <= skiprows) if skiprows > 0 else None
+        yield from pd.read_csv(path, usecols=columns, skiprows=skip, chunksize=chunksize)
+
+
+class TableWriter:
+    """
+    Writer of a table in chunks. The format is given by the extension of the path.
+
+    CSV chunks are appended to the file as they are written. Parquet and Feather chunks are written as row groups / record
+    batches of a single file, and NPY chunks are streamed to the file after a fixed size header, which is completed with the final
+    number of rows when the writer is closed (so the output is never held in memory).
+    Only CSV outputs can be appended to an existing file.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.format = table_format(path)
+        self.append = append
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._empty = None
+        self._file = None
+        self._dtype = None
+        self._width = None
+        self._started = False
+        if append and self.format != 'csv':
+            raise ValueError("Appending to an existing file is only supported for CSV outputs")
+        if self.format in ['parquet', 'feather']:
+            self._pa = _import_pyarrow()
+
+    def write(self, df):
+        """Write a chunk of rows (dataframe) to the table."""
+        if self.format == 'csv':
+            first = not self._started and not self.append
+            df.to_csv(self.path, mode='w' if first else 'a', header=first, index=False)
+        elif self.format in ['parquet', 'feather']:
+            pa = self._pa
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None and table.num_rows == 0:
+                # Empty chunks do not tell the types of the columns, wait for the first rows (or the end of the table)
+                self._empty = table
+                self._started = True
+                return
+            if self._writer is None:
+                self._open_writer(self._first_schema(table))
+            # Chunks may infer different types (e.g. int and float), use the types of the first chunk
+            self._writer.write_table(self._cast(table))
+        else:
+            values = df.to_numpy()
+            if not np.issubdtype(values.dtype, np.number):
+                raise ValueError("NPY outputs can only contain numerical columns")
+            if self._file is None:
+                # The type and number of columns of the first chunk are used for the whole array
+                self._dtype = values.dtype
+                self._width = values.shape[1]
+                self._file = open(self.path, 'wb')
+                self._file.write(self._npy_header(0))
+            elif values.shape[1] != self._width:
+                raise ValueError("All the chunks of a NPY output must have the same number of columns")
+            elif not np.can_cast(values.dtype, self._dtype, casting='same_kind'):
+                raise ValueError("The chunks of a NPY output must have the same type, got " + str(values.dtype) + " after " + str(self._dtype))
+            self._file.write(np.ascontiguousarray(values, dtype=self._dtype).data)
+        self._started = True
+        self.rows += len(df)
+
+    def _open_writer(self, schema):
+        # Create the Parquet / Feather file with the schema of the output
+        self._schema = schema
+        if self.format == 'parquet':
+            self._writer = self._pa.parquet.ParquetWriter(self.path, schema)
+        else:
+            self._writer = self._pa.ipc.new_file(self.path, schema)
+
+    def _first_schema(self, table):
+        # Schema of the output, from the first chunk. Columns without any value in the first chunk (e.g. a text field of a CSV file
+        # that is empty in the first rows) have no meaningful type, so they are written as text: later values of any type fit in it
+        pa = self._pa
+        fields = [pa.field(field.name, pa.large_string()) if table.column(i).null_count == table.num_rows else field
+                  for i, field in enumerate(table.schema)]
+        return pa.schema(fields, metadata=table.schema.metadata)
+
+    def _cast(self, table):
+        # Cast each column of a chunk to the type of the output, naming the column if its values do not fit
+        pa = self._pa
+        if table.schema.names != self._schema.names:
+            raise ValueError("All the chunks of the output must have the same columns: got " + str(table.schema.names) +
+                             " after " + str(self._schema.names))
+        columns = []
+        for i, field in enumerate(self._schema):
+            column = table.column(i)
+            try:
+                columns.append(column if column.type == field.type else column.cast(field.type))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError) as e:
+                raise ValueError("Column [" + field.name + "] has " + str(column.type) + " values that cannot be written as " +
+                                 str(field.type) + " (the type of the column in the first chunk of rows): " + str(e))
+        return pa.Table.from_arrays(columns, schema=self._schema)
+
+    def _npy_header(self, rows):
+        # NPY (version 1.0) header of a C ordered array of rows x width entries, padded with spaces to _NPY_HEADER_SIZE bytes
+        header = repr({'descr': np.lib.format.dtype_to_descr(self._dtype), 'fortran_order': False, 'shape': (rows, self._width)})
+        header = header.encode('latin1').ljust(_NPY_HEADER_SIZE - 10 - 1) + b'\n'
+        return np.lib.format.magic(1, 0) + np.uint16(len(header)).astype('<u2').tobytes() + header
+
+    def close(self):
+        """Finish writing the table."""
+        if self._writer is None and self._empty is not None:
+            # Only empty chunks were written: the table has no rows, with the columns (and types) of the first chunk
+            self._open_writer(self._empty.schema)
+            self._writer.write_table(self._empty)
+        self._empty = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            # Complete the header with the number of rows written
+            self._file.seek(0)
+            self._file.write(self._npy_header(self.rows))
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_table(df, path):
+    """
+    Write a dataframe to a table, the format is given by the extension of the path.
+    """
+    with TableWriter(path) as writer:
+        writer.write(df)
@@ -21,14 +21,215 @@
 
 # Optional arguments:
 # --utm: flag to indicate that UTM coordinates will be generated from input latitude and longitude
+# --zone: UTM zone used for all the entries (e.g. 30N). By default, the zone and hemisphere of each entry are used
 # --slim: flag to indicate that the output file will only contain the id, relative_path, georeferencing fields and latent variables
 # --key: name of the column acting as unique identifier in the original dataset. Default is 'relative_path'
+# --join: how the entries are matched: 'key' (by the --key column, present in both files), 'position' (row by row, both files must have
+#         the same number of entries) or 'auto' (default: by key if the latent file has the --key column, otherwise by position)
+# --how: keyed join type: 'inner' (default, only the entries with latents) or 'left' (all the input entries, empty latents if not matched)
+# --chunksize: merge the files out-of-core, reading and writing chunks of this number of rows. Positional joins read both files in
+#              lockstep. Keyed joins first read the keys of the latent file (duplicated keys are rejected before writing, as in memory),
+#              then keep the input dataset in memory (indexed by key) and stream the latents. The merged entries are the same as in
+#              memory, but the output follows the order of the latent file, and unmatched input entries (left join) are written at the end
 
-# Include libraries for argument parsing, pyproj for coordinate transformations, and pandas for data manipulation
+# Include libraries for argument parsing, pandas for data manipulation, and the geo module (pyproj) for coordinate transformations
 import argparse
-import pyproj
 import pandas as pd
 import os, sys, csv
+import collections
+import itertools
+import numpy as np
+
+from latent_io import read_header, read_table, iter_table, write_table, TableWriter
+from geo import add_utm_columns, parse_zone, report_zones
+
+# Join modes and keyed join types
+JOIN_MODES = ['auto', 'key', 'position']
+JOIN_TYPES = ['inner', 'left']
+
+
+def key_join(keys, latent_keys):
+    """
+    Match the entries of the input dataset to the entries of the latent file by key, using a hash index of the latent keys.
+
+    Inputs:
+    - keys: array of keys of the input dataset (duplicated keys are allowed, they receive the same latents).
+    - latent_keys: array of keys of the latent file. They must be unique.
+
+    Outputs:
+    - positions: array with the row of the latent file matching each input entry, -1 if the key is not in the latent file.
+    """
+    index = pd.Index(latent_keys)
+    if not index.is_unique:
+        duplicated = index[index.duplicated()].unique()
+        raise ValueError(str(len(duplicated)) + " duplicated key(s) in the latent file, e.g. " + ", ".join(map(str, duplicated[:5])))
+    return index.get_indexer(keys)
+
+
+def report_unmatched(keys, latent_keys, positions, max_examples=5):
+    # Print the number of input entries without latents and latent entries without input, with a few examples of each
+    unmatched = positions < 0
+    if unmatched.any():
+        examples = pd.unique(np.asarray(keys)[unmatched])[:max_examples]
+        print ('Input entries without latents: ' + str(unmatched.sum()) + ' (e.g. ' + ', '.join(map(str, examples)) + ')')
+    used = np.zeros(len(latent_keys), dtype=bool)
+    used[positions[~unmatched]] = True
+    if not used.all():
+        examples = np.asarray(latent_keys)[~used][:max_examples]
+        print ('Latent entries without input: ' + str((~used).sum()) + ' (e.g. ' + ', '.join(map(str, examples)) + ')')
+
+
+def join_latents(df, df_latent, positions, how='inner'):
+    """
+    Append the latent rows matched to each input entry (see key_join).
+
+    Inputs:
+    - df: input dataframe.
+    - df_latent: dataframe with the latent columns.
+    - positions: row of df_latent matching each row of df, -1 if not matched.
+    - how: 'inner' keeps only the matched entries, 'left' keeps all the input entries (unmatched latents are NaN).
+
+    Outputs:
+    - df_merged: input rows (in input order) with the latent columns appended.
+    """
+    if how == 'inner':
+        keep = positions >= 0
+        df = df[keep]
+        positions = positions[keep]
+        latents = df_latent.take(positions)
+    else:
+        # Position -1 is not a row of the latents, so unmatched entries receive NaN
+        latents = df_latent.reset_index(drop=True).reindex(positions)
+    latents.index = df.index
+    return pd.concat([df, latents], axis=1)
+
+
+class KeyIndex:
+    """
+    Hash index of the keys of a table, mapping each key to all the rows where it appears (keys may be duplicated).
+    """
+
+    def __init__(self, keys):
+        self.keys = pd.Index(keys).unique()
+        codes = self.keys.get_indexer(keys)
+        # Rows grouped by key: the rows of key i are rows[starts[i]:starts[i+1]]
+        self.rows = np.argsort(codes, kind='stable')
+        self.starts = np.searchsorted(codes[self.rows], np.arange(len(self.keys) + 1))
+
+    def probe(self, keys):
+        """
+        Find the rows matching each of the probed keys.
+
+        Outputs:
+        - probe_idx: position of the probed key of each match.
+        - rows: row of the indexed table of each match.
+        """
+        codes = self.keys.get_indexer(keys)
+        found = np.flatnonzero(codes >= 0)
+        codes = codes[found]
+        counts = self.starts[codes + 1] - self.starts[codes]
+        probe_idx = np.repeat(found, counts)
+        # Offset of each match inside the rows of its key
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return probe_idx, self.rows[np.repeat(self.starts[codes], counts) + offsets]
+
+
+def rechunk(chunks, chunksize):
+    # Regroup an iterator of dataframes into chunks of exactly chunksize rows (except the last one), so that two tables can be
+    # read in lockstep even if their readers return chunks of different sizes (e.g. Parquet row groups)
+    buffer = None
+    for chunk in chunks:
+        buffer = chunk if buffer is None else pd.concat([buffer, chunk])
+        while len(buffer) >= chunksize:
+            yield buffer.iloc[:chunksize]
+            buffer = buffer.iloc[chunksize:]
+    if buffer is not None and len(buffer) > 0:
+        yield buffer
+
+
+def merge_by_position_streaming(input_file, latent_file, writer, columns, chunksize, utm=False, zone=None):
+    """
+    Merge the input and latent files row by row, reading both in lockstep chunks and writing each merged chunk to the writer.
+
+    Inputs:
+    - input_file, latent_file: paths to the input dataset and the latent file.
+    - writer: TableWriter of the output.
+    - columns: columns exported from the input dataset (None for all).
+    - chunksize: number of rows per chunk.
+    - utm: flag to append the UTM coordinates, projected chunk by chunk.
+    - zone: UTM zone used for all the entries. If None, the zone of each entry is used.
+
+    Outputs:
+    - entries: number of merged entries.
+    """
+    inputs = rechunk(iter_table(input_file, chunksize, columns=columns), chunksize)
+    latent_columns = [x for x in read_header(latent_file) if x.startswith('latent_')]
+    latents = rechunk(iter_table(latent_file, chunksize, columns=latent_columns), chunksize)
+    zones = collections.Counter()
+    entries = 0
+    for df, df_latent in itertools.zip_longest(inputs, latents):
+        if df is None or df_latent is None or len(df) != len(df_latent):
+            raise ValueError('input and latent files do not have the same number of entries.')
+        df = df[columns].copy() if columns is not None else df.copy()
+        if utm:
+            zones.update(add_utm_columns(df, zone))
+        df_latent.index = df.index
+        writer.write(pd.concat([df, df_latent], axis=1))
+        entries += len(df)
+    if utm:
+        report_zones(zones)
+    return entries
+
+
+def merge_by_key_streaming(df, latent_file, writer, key, chunksize, how='inner', utm=False, zone=None):
+    """
+    Merge the input dataset and the latent file by key. The keys of the latent file are read first (only the key column), so
+    duplicated latent keys are rejected and the unmatched entries are reported before anything is written, as in the in-memory join.
+    Then the input dataset (the smaller side, without latents) is indexed by key in memory, and the latent file is streamed in
+    chunks, each chunk probing the index. The merged entries are the same as in the in-memory join (see join_latents), but they
+    are written in the order of the latent file; with a left join, the input entries without latents are written at the end.
+
+    Inputs:
+    - df: input dataframe (only the exported columns, including the key).
+    - latent_file: path to the latent file.
+    - writer: TableWriter of the output.
+    - key: name of the key column.
+    - chunksize: number of latent rows per chunk.
+    - how: 'inner' or 'left' (see join_latents).
+    - utm: flag to append the UTM coordinates, computed once for the whole input dataset.
+    - zone: UTM zone used for all the entries. If None, the zone of each entry is used.
+
+    Outputs:
+    - entries: number of merged entries.
+    """
+    # Key-only pass over the latent file: raises ValueError on duplicated latent keys
+    keys = df[key].to_numpy()
+    latent_keys = read_table(latent_file, columns=[key])[key].to_numpy()
+    positions = key_join(keys, latent_keys)
+    report_unmatched(keys, latent_keys, positions)
+    del latent_keys
+
+    if utm:
+        report_zones(add_utm_columns(df, zone))
+    index = KeyIndex(keys)
+    latent_columns = [x for x in read_header(latent_file) if x.startswith('latent_')]
+    entries = 0
+    for df_latent in iter_table(latent_file, chunksize, columns=[key] + latent_columns):
+        latent_idx, rows = index.probe(df_latent[key].to_numpy())
+        merged = df.take(rows).reset_index(drop=True)
+        latents = df_latent[latent_columns].take(latent_idx).reset_index(drop=True)
+        writer.write(pd.concat([merged, latents], axis=1))
+        entries += len(merged)
+
+    if how == 'left':
+        # Input entries without latents, with empty latents
+        unmatched = np.flatnonzero(positions < 0)
+        for start in range(0, len(unmatched), chunksize):
+            merged = df.take(unmatched[start:start + chunksize]).reset_index(drop=True)
+            latents = pd.DataFrame(np.nan, index=merged.index, columns=latent_columns)
+            writer.write(pd.concat([merged, latents], axis=1))
+            entries += len(merged)
+    return entries
 
 
 def main(args=None):
@@ -50,7 +251,7 @@ def main(args=None):
         "-l",
         "--latent",
         type=str,
-        help="CSV containing the latent variables to be appended to the input dataset."
+        help="CSV containing the latent variables to be appended to the input dataset. Parquet, Feather and NPY (as exported by the feature extractor) files are also accepted."
     )
     # output #########################
     parser.add_argument(
@@ -66,7 +267,22 @@ def main(args=None):
         "--key",
         default='relative_path',
         type=str,
-        help="Keyword that defines the field (columns) from source that will be appended to target."
+        help="Column acting as unique identifier of the entries (e.g. relative_path). Used to join the input and latent files when both have it."
+    )
+    parser.add_argument(
+        "-j",
+        "--join",
+        default='auto',
+        type=str,
+        choices=JOIN_MODES,
+        help="How the input and latent entries are matched: 'key' (by the --key column), 'position' (row by row, same number of entries) or 'auto' (by key if the latent file has the --key column, otherwise by position). Default: auto"
+    )
+    parser.add_argument(
+        "--how",
+        default='inner',
+        type=str,
+        choices=JOIN_TYPES,
+        help="Keyed join type: 'inner' (only input entries with latents) or 'left' (all the input entries, empty latents when not matched). Default: inner"
     )
     parser.add_argument(
         "-u",
@@ -74,12 +290,26 @@ def main(args=None):
         action='store_true',
         help="Flag to indicate that UTM coordinates will be generated from input latitude and longitude."
     )
+    parser.add_argument(
+        "-z",
+        "--zone",
+        default=None,
+        type=str,
+        help="UTM zone used to project all the entries with --utm, e.g. 30N or 30S. Default: the zone and hemisphere of each entry"
+    )
     parser.add_argument(
         "-s",
         "--slim",
         action='store_true',
         help="Flag to indicate that the output file will only contain the id, relative_path, georeferencing fields and latent variables."
     )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        default=None,
+        type=int,
+        help="Merge out-of-core, reading and writing chunks of this number of rows. Positional joins read both files in lockstep and give the same output as in memory. Keyed joins check the latent keys first (duplicated keys are rejected, as in memory), then keep the input dataset indexed in memory and stream the latents: the merged entries are the same as in memory, but the output follows the order of the latent file instead of the input file, and with --how left the input entries without latents are written at the end. Default: merge in memory"
+    )
 
     # parse arguments
     args = parser.parse_args(args)
@@ -108,73 +338,117 @@ def main(args=None):
         print ('Provided output file: [' + args.output + '] already exists. Overwriting...')
 
 
-    # Read the input file as a pandas dataframe
-    df = pd.read_csv(args.input)
+    if args.chunksize is not None and args.chunksize < 1:
+        print ('The chunk size must be a positive integer.')
+        exit()
+
+    # Read the column names of the input file (the rows are read later, all at once or in chunks)
+    input_columns = read_header(args.input)
 
     # Check if it has the required fields: relative_path, latitude [deg], longitude [deg]
-    if not all(x in df.columns for x in ['relative_path', 'latitude [deg]', 'longitude [deg]']):
+    if not all(x in input_columns for x in ['relative_path', 'latitude [deg]', 'longitude [deg]']):
         print ('Input file: [' + args.input + '] does not have the required fields: relative_path, latitude [deg], longitude [deg].')
         exit()
-    
-    # Print the total number of entries in the input file. Also print the number of columns
-    print ('Input has ' + str(len(df)) + ' entries and ' + str(len(df.columns)) + ' columns.')
 
-    # Read the latent file as a pandas dataframe
-    df_latent = pd.read_csv(args.latent)
+    # Read the column names of the latent file
+    latent_columns = read_header(args.latent)
     # Check if it has fields containing the latent key preffix: "latent_"
-    if not any(x.startswith('latent_') for x in df_latent.columns):
+    if not any(x.startswith('latent_') for x in latent_columns):
         print ('Latent file: [' + args.latent + '] does not have any fields starting with "latent_"')
         exit()
 
+    # Decide how the entries are matched. A keyed join needs the key in both files
+    join = args.join
+    if join == 'auto':
+        join = 'key' if args.key in latent_columns and args.key in input_columns else 'position'
+    if join == 'key':
+        for name, columns, filename in [('Input', input_columns, args.input), ('Latent', latent_columns, args.latent)]:
+            if args.key not in columns:
+                print (name + ' file: [' + filename + '] does not have the key field: ' + args.key)
+                exit()
+        print ('Joining input and latent entries by key: ' + args.key + ' (' + args.how + ' join)')
+
+    # Check if the --slim flag was provided. If so, only the relative_path, latitude [deg], longitude [deg] from the input file will be added
+    export_columns = None
+    if args.slim:
+        export_columns = ['relative_path', 'latitude [deg]', 'longitude [deg]']
+        if join == 'key' and args.key not in export_columns:
+            export_columns = [args.key] + export_columns
+        # Print a message informing that only the relative_path, latitude [deg], longitude [deg] fields will be added because of the --slim flag
+        print ('Flag --slim used. Only the relative_path, latitude [deg], longitude [deg] fields will be exported from the input file.')
+    if args.utm:
+        # Print a message informing that UTM coordinates will be generated from the input latitude and longitude
+        print ('Flag --utm used. UTM coordinates will be generated from the input latitude and longitude.')
+        if args.zone is not None:
+            try:
+                parse_zone(args.zone)
+            except ValueError as e:
+                print (e.args[0])
+                exit()
+
+    if args.chunksize is not None:
+        # Out-of-core merge: the merged chunks are written as soon as they are built
+        print ('Merging in chunks of ' + str(args.chunksize) + ' rows and writing to file: ' + args.output)
+        try:
+            with TableWriter(args.output) as writer:
+                if join == 'key':
+                    df = read_table(args.input, columns=export_columns)
+                    entries = merge_by_key_streaming(df[export_columns] if export_columns is not None else df, args.latent, writer,
+                                                     args.key, args.chunksize, args.how, args.utm, args.zone)
+                else:
+                    entries = merge_by_position_streaming(args.input, args.latent, writer, export_columns, args.chunksize, args.utm, args.zone)
+        except ValueError as e:
+            # The partial output is removed
+            print ('Error: ' + str(e))
+            if os.path.isfile(args.output):
+                os.remove(args.output)
+            exit()
+        print ('Merged ' + str(entries) + ' entries.')
+        return
+
+    # Read the input file as a pandas dataframe
+    df = read_table(args.input)
+    # Print the total number of entries in the input file. Also print the number of columns
+    print ('Input has ' + str(len(df)) + ' entries and ' + str(len(df.columns)) + ' columns.')
+
+    # Read the latent file as a pandas dataframe
+    df_latent = read_table(args.latent)
+    if join == 'key':
+        latent_keys = df_latent[args.key].to_numpy()
+
     # Filter the latent dataframe to only contain the fields starting with "latent_"
     df_latent = df_latent.filter(regex='latent_')
     # Print the total number of entries in the latent file. Also print the number of latent columns
     print ('Latent file has ' + str(len(df_latent)) + ' entries and ' + str(len(df_latent.columns)) + ' columns.')
 
+    if join == 'key':
+        # Match the input entries to the latents through a hash index of the latent keys
+        keys = df[args.key].to_numpy()
+        try:
+            positions = key_join(keys, latent_keys)
+        except ValueError as e:
+            print ('Error: ' + str(e))
+            exit()
+        report_unmatched(keys, latent_keys, positions)
     # Check if the number of entries in the input and latent files match
-    if len(df) != len(df_latent):
+    elif len(df) != len(df_latent):
         print ('Error: input and latent files do not have the same number of entries.')
         exit()
 
     # Create the dataframe that will contain the merged data
-    df_merged = pd.DataFrame()
-
-    # Check if the --slim flag was provided. If so, only the relative_path, latitude [deg], longitude [deg] from the input file will be added
-    if args.slim:
-        df_merged = df[['relative_path', 'latitude [deg]', 'longitude [deg]']]
-        # Print a message informing that only the relative_path, latitude [deg], longitude [deg] fields will be added because of the --slim flag
-        print ('Flag --slim used. Only the relative_path, latitude [deg], longitude [deg] fields will be exported from the input file.')
-    else:
-        df_merged = df
-
-    # From the original dataframe, get the index of the latitude and longitude columns
-    lat_index = df.columns.get_loc('latitude [deg]')
-    lon_index = df.columns.get_loc('longitude [deg]')
+    df_merged = df[export_columns].copy() if export_columns is not None else df.copy()
 
     # Check if the --utm flag was provided. If so, UTM coordinates will be generated from the input latitude and longitude
     if args.utm:
-        # Print a message informing that UTM coordinates will be generated from the input latitude and longitude
-        print ('Flag --utm used. UTM coordinates will be generated from the input latitude and longitude.')
-        # Let's determine the UTM zone from the input longitude. Sample first entry
-        lon = df['longitude [deg]'][0]
-        # Determine the UTM zone
-        utm_zone = int((lon + 180) / 6) + 1
-        # Print the UTM zone
-        print ('UTM zone: ' + str(utm_zone))
-        # Create the UTM projection as a new object
-        utm = pyproj.Proj(proj='utm', zone=utm_zone, ellps='WGS84', datum='WGS84')
-        # For each entry in the dataframe, convert the latitude and longitude to UTM coordinates and add them to the dataframe
-        # The UTM coluns are: "easting_utm", "northing_utm"
-        easting, northing = utm(df['longitude [deg]'].values, df['latitude [deg]'].values)
-
-        # Append the new columns to the dataframe df_merged (they are numpy.ndarrays)
-        df_merged['northing_utm [m]'] = northing.tolist()
-        df_merged['easting_utm [m]'] = easting.tolist()
+        # Append the UTM columns to the dataframe df_merged: "northing_utm [m]", "easting_utm [m]"
+        # The UTM zone and hemisphere are determined for each entry (unless --zone is provided)
+        report_zones(add_utm_columns(df_merged, args.zone))
 
     # Append the latent variables to the merged dataframe. Use only the fields starting with "latent_"
-    # First we filter the latent dataframe to only contain the fields starting with "latent_"
-    df_latent = df_latent.filter(regex='latent_')
-    df_merged = pd.concat([df_merged, df_latent], axis=1)
+    if join == 'key':
+        df_merged = join_latents(df_merged, df_latent, positions, args.how)
+    else:
+        df_merged = pd.concat([df_merged, df_latent], axis=1)
 
     # Print the total number of entries in the merged dataframe. Also print the number of columns
     # It should match those from the input file
@@ -182,7 +456,8 @@ def main(args=None):
 
     print ('Writing merged dataframe to file: ' + args.output)
     # Write the merged dataframe to a csv file``
-    df_merged.to_csv(args.output, index=False)
+    # The output format (CSV, Parquet, Feather) is given by the extension of the output file
+    write_table(df_merged, args.output)
 
 # Add main as the entry point for the script
 if __name__ == "__main__":
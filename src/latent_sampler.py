@@ -6,6 +6,11 @@ import numpy as np
 import os 
 import sys
 import signal
+import functools
+
+from spatial_index import build_index, IndexPool, INDEX_BACKENDS
+from latent_io import read_header, read_table, iter_table, table_format, TableWriter
+from geo import add_utm_columns, central_zone, has_latlon, has_utm, parse_zone
 
 # Add handler for the SIGINT signal
 def signal_handler(sig, frame):
@@ -13,6 +18,153 @@ def signal_handler(sig, frame):
 #    sys.exit(0)
 
 
+def assemble_results(df_target, df_source, fields_to_append, target_idx, source_idx, distance):
+    """
+    Build the output table from the list of matches with a single gather from the TARGET and SOURCE tables.
+
+    Inputs:
+    - df_target: TARGET dataframe.
+    - df_source: SOURCE dataframe.
+    - fields_to_append: columns of the SOURCE dataframe appended to each TARGET entry (prefixed with 'source_').
+    - target_idx, source_idx: arrays of size P with the TARGET and SOURCE row positions of each match.
+    - distance: array of size P with the distance of each match.
+
+    Outputs:
+    - df_results: dataframe with P rows: the TARGET columns, the 'source_' columns and the 'match_distance' column.
+    """
+    # Gather the TARGET rows (one per match). Column dtypes are preserved
+    df_results = df_target.take(target_idx).reset_index(drop=True)
+
+    # Gather the SOURCE fields for each match
+    df_matches = df_source[list(fields_to_append)].take(source_idx).reset_index(drop=True)
+    df_matches.columns = ['source_' + field for field in fields_to_append]
+    df_matches['match_distance'] = np.asarray(distance, dtype=np.float64)
+
+    # Appended fields that already exist in the TARGET are overwritten in place, the rest are appended as new columns
+    overlap = df_matches.columns.intersection(df_results.columns)
+    for column in overlap:
+        df_results[column] = df_matches[column]
+    df_results = pd.concat([df_results, df_matches.drop(columns=overlap)], axis=1)
+
+    return df_results
+
+
+# Sampler modes. The random modes select among all the SOURCE candidates within the distance threshold
+SAMPLER_MODES = ['closest', 'all', 'knn', 'random', 'random-k']
+# Weighting of the candidates in the random modes
+RANDOM_WEIGHTING = ['uniform', 'distance']
+
+
+def _mix64(x):
+    # splitmix64 finalizer, applied element-wise over uint64 arrays (overflow wraps around)
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def random_uniform(seed, target_row, source_row):
+    """
+    Deterministic uniform random numbers in (0, 1] for each (target, source) pair.
+
+    The numbers are a hash of the seed and the pair, so they do not depend on the order in which the pairs are
+    generated (chunk size, number of workers or resumed runs).
+
+    Inputs:
+    - seed: integer seed.
+    - target_row, source_row: arrays of size P with the TARGET and SOURCE row number of each pair.
+
+    Outputs:
+    - u: array of size P with the random numbers.
+    """
+    h = _mix64(np.full(len(target_row), seed % 2**64, dtype=np.uint64))
+    h = _mix64(h ^ np.asarray(target_row).astype(np.uint64))
+    h = _mix64(h ^ np.asarray(source_row).astype(np.uint64))
+    # Use the upper 53 bits as the mantissa of a double
+    return ((h >> np.uint64(11)).astype(np.float64) + 1.0) * 2.0**-53
+
+
+def select_random(target_idx, source_idx, distance, k, seed, weighting='uniform', target_offset=0):
+    """
+    Randomly select up to k matches per TARGET entry among its candidates (sampling without replacement).
+
+    Inputs:
+    - target_idx, source_idx, distance: candidate matches, as returned by SpatialIndex.query.
+    - k: number of matches selected per TARGET entry.
+    - seed: integer seed of the selection.
+    - weighting: 'uniform' (every candidate is equally likely) or 'distance' (candidates are weighted by 1 / (1 + distance)).
+    - target_offset: row number of the first TARGET entry, used to make the selection independent of the chunking.
+
+    Outputs:
+    - target_idx, source_idx, distance: selected matches, sorted by TARGET position, then by distance and then by SOURCE position.
+    """
+    if len(target_idx) == 0:
+        return target_idx, source_idx, distance
+
+    # Weighted sampling without replacement (Efraimidis-Spirakis): each candidate gets the key log(u) / w and the k largest keys per TARGET are kept
+    u = random_uniform(seed, target_idx + target_offset, source_idx)
+    if weighting == 'distance':
+        key = np.log(u) * (1.0 + distance)
+    else:
+        key = np.log(u)
+
+    order = np.lexsort((source_idx, -key, target_idx))
+    t = target_idx[order]
+    first = np.r_[True, t[1:] != t[:-1]]
+    group_start = np.maximum.accumulate(np.where(first, np.arange(len(t)), 0))
+    selected = order[(np.arange(len(t)) - group_start) < k]
+
+    # Restore the (target, distance, source) order of the matches
+    selected = selected[np.lexsort((source_idx[selected], distance[selected], target_idx[selected]))]
+    return target_idx[selected], source_idx[selected], distance[selected]
+
+
+def select_uniform(tgt_n, tgt_e, src_n, src_e, k, seed, target_offset=0):
+    """
+    Randomly select up to k SOURCE entries per TARGET entry among all the SOURCE entries (no distance threshold, uniform weighting).
+
+    Every SOURCE entry is a candidate, so the selection is drawn directly (Floyd's sampling without replacement) instead of
+    generating the (target, source) candidate pairs: it only uses O(k) memory and time per TARGET entry. As in select_random,
+    the random numbers only depend on the seed and the TARGET row number. Entries with non-finite coordinates are never selected.
+
+    Inputs:
+    - tgt_n, tgt_e: TARGET coordinates, arrays of size N.
+    - src_n, src_e: SOURCE coordinates, arrays of size M.
+    - k: number of matches selected per TARGET entry.
+    - seed: integer seed of the selection.
+    - target_offset: row number of the first TARGET entry, used to make the selection independent of the chunking.
+
+    Outputs:
+    - target_idx, source_idx, distance: selected matches, sorted by TARGET position, then by distance and then by SOURCE position.
+    """
+    tgt_n = np.asarray(tgt_n, dtype=np.float64)
+    tgt_e = np.asarray(tgt_e, dtype=np.float64)
+    src_n = np.asarray(src_n, dtype=np.float64)
+    src_e = np.asarray(src_e, dtype=np.float64)
+    sources = np.flatnonzero(np.isfinite(src_n) & np.isfinite(src_e))
+    targets = np.flatnonzero(np.isfinite(tgt_n) & np.isfinite(tgt_e))
+    m = len(sources)
+    k = min(k, m)
+    if k == 0 or len(targets) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+    # Floyd's algorithm: for j = m-k .. m-1, draw a position in [0, j], or take j if the position was already selected
+    rows = targets + target_offset
+    chosen = np.empty((len(targets), k), dtype=np.int64)
+    for i, j in enumerate(range(m - k, m)):
+        # The draws use source rows beyond any real SOURCE row, so they are independent of the pair numbers of select_random
+        u = random_uniform(seed, rows, np.full(len(rows), 2**63 + i, dtype=np.uint64))
+        pick = np.minimum(((1.0 - u) * (j + 1)).astype(np.int64), j)
+        taken = (chosen[:, :i] == pick[:, None]).any(axis=1)
+        chosen[:, i] = np.where(taken, j, pick)
+
+    target_idx = np.repeat(targets, k)
+    source_idx = sources[chosen.ravel()]
+    distance = np.sqrt((src_n[source_idx] - tgt_n[target_idx])**2 + (src_e[source_idx] - tgt_e[target_idx])**2)
+    order = np.lexsort((source_idx, distance, target_idx))
+    return target_idx[order], source_idx[order], distance[order]
+
+
 # Create the parser and add arguments
 def main(args=None):
 
@@ -30,7 +182,7 @@ def main(args=None):
         "-s",
         "--source",
         type=str,
-        help="CSV containing the SOURCE of georeferenced entries to be matched against target entries using distance based criteria"
+        help="CSV (or Parquet/Feather/NPY) containing the SOURCE of georeferenced entries to be matched against target entries using distance based criteria"
     )
     # latent
     parser.add_argument(
@@ -38,7 +190,7 @@ def main(args=None):
         "--target",
         type=str,
         # default=None,
-        help="CSV containing the TARGET of georeferenced entries to be matched against source entries using distance based criteria"
+        help="CSV (or Parquet/Feather/NPY) containing the TARGET of georeferenced entries to be matched against source entries using distance based criteria"
     )
     parser.add_argument(
         "-k",
@@ -53,7 +205,7 @@ def main(args=None):
         "--output",
         default='sampled_latents.csv',
         type=str,
-        help="File containing a copy of the TARGET layer with the sampled (matching) entries from the SOURCE layer appended to it."
+        help="File containing a copy of the TARGET layer with the sampled (matching) entries from the SOURCE layer appended to it. The format (CSV, Parquet, Feather, NPY) is given by the extension."
     )
 
     # distance #########################
@@ -71,7 +223,74 @@ def main(args=None):
         "--mode",
         default='closest',
         type=str,
-        help="Mode of the sampler. Options are: 'closest' (default), 'random', 'all'."
+        help="Mode of the sampler. Options are: 'closest' (default), 'all', 'knn', 'random', 'random-k'."
+    )
+    parser.add_argument(
+        "-n",
+        "--neighbours",
+        default=1,
+        type=int,
+        help="Number of SOURCE entries appended to each TARGET entry when using the 'knn' (nearest) or 'random-k' (random) modes."
+    )
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="Seed of the 'random' and 'random-k' modes. If not provided, a random seed is generated (and printed)."
+    )
+    parser.add_argument(
+        "--weighting",
+        default='uniform',
+        type=str,
+        choices=RANDOM_WEIGHTING,
+        help="Weighting of the SOURCE candidates in the 'random' and 'random-k' modes. Options are: 'uniform' (default), 'distance' (weight 1 / (1 + distance))."
+    )
+
+    # spatial index #########################
+    parser.add_argument(
+        "--index",
+        default='kdtree',
+        type=str,
+        choices=INDEX_BACKENDS,
+        help="Spatial index used to search the SOURCE entries. Options are: 'kdtree' (default), 'grid', 'brute' (reference mode, exhaustive search)."
+    )
+    parser.add_argument(
+        "--cellsize",
+        default=None,
+        type=float,
+        help="Cell size [m] of the 'grid' spatial index. If not provided, the distance threshold (or the SOURCE density) is used."
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of worker processes used to query the spatial index. The output does not depend on the number of workers."
+    )
+
+    # georeferencing #########################
+    parser.add_argument(
+        "-z",
+        "--zone",
+        default=None,
+        type=str,
+        help="UTM zone (e.g. 30N) used to compute the UTM coordinates of the layers that only have latitude and longitude. Both layers must be in the same zone. If not provided, the zone of the centre of the SOURCE layer is used."
+    )
+
+    # streaming #########################
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        default=None,
+        type=int,
+        help="Number of TARGET entries read and processed at once. The matches of each chunk are appended to the output file as soon as they are ready. If not provided, the whole TARGET file is processed at once."
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        default=0,
+        type=int,
+        help="Number of TARGET entries to skip (already processed in a previous run). The new results are appended to the existing output file."
     )
 
     # parse arguments
@@ -96,15 +315,35 @@ def main(args=None):
         print ("TARGET file not found")
         exit()
     
+    # Check the number of workers
+    if args.workers < 1:
+        print ("The number of workers must be a positive integer.")
+        exit()
+
+    # Check the streaming options
+    if args.chunksize is not None and args.chunksize < 1:
+        print ("The chunk size must be a positive integer.")
+        exit()
+    if args.resume < 0:
+        print ("The number of TARGET entries to resume from must be a positive integer.")
+        exit()
+
     # Check if the output file exists, print a warning message and continue
-    if os.path.isfile(args.output):
+    # When resuming, the results are appended to the existing output file
+    append_output = args.resume > 0 and os.path.isfile(args.output)
+    if append_output and table_format(args.output) != 'csv':
+        print ("Resuming (appending to an existing output file) is only supported for CSV outputs.")
+        exit()
+    if append_output:
+        print ('Resuming from TARGET entry [' + str(args.resume) + ']. Appending results to: [' + args.output + ']')
+    elif os.path.isfile(args.output):
         print ('Provided output file: [' + args.output + '] already exists. Overwriting...')
 
     # Read the input SOURCE file as a pandas dataframe
-    df_source = pd.read_csv(args.source)
+    df_source = read_table(args.source)
 
-    # Read the input TARGET file as a pandas dataframe
-    df_target = pd.read_csv(args.target)
+    # Read the header of the input TARGET file. The TARGET entries are read later on (whole file or chunks)
+    target_columns = read_header(args.target)
 
     # Check if the provided key exists in the SOURCE file
     if args.key is not None:
@@ -123,99 +362,152 @@ def main(args=None):
         # else:
         #     print ("Provided key: [" + args.key + "] found in SOURCE file.")
 
-    # Check if the SOURCE dataframe contains the UTM fields: 'northing_utm [m]' and 'easting_utm [m]'
-    # We could calculate them, but for now we will assume that they are already there. External tools to convert to UTM is already provided twice
-    if 'northing_utm [m]' not in df_source.columns:
-        print ("SOURCE file does not contain the northing_utm [m] field.")
-        exit()
-    if 'easting_utm [m]' not in df_source.columns:
-        print ("SOURCE file does not contain the easting_utm [m] field.")
-        exit()
+    # Check if the SOURCE and TARGET layers contain the UTM fields: 'northing_utm [m]' and 'easting_utm [m]'
+    # If a layer only has 'latitude [deg]' and 'longitude [deg]', its UTM coordinates are computed on the fly (no need to run append_utm first)
+    for name, columns in [("SOURCE", df_source.columns), ("TARGET", target_columns)]:
+        if not has_utm(columns) and not has_latlon(columns):
+            print (name + " file does not contain the northing_utm [m] and easting_utm [m] fields (nor latitude [deg] and longitude [deg] to compute them).")
+            exit()
+    source_utm = not has_utm(df_source.columns)
+    target_utm = not has_utm(target_columns)
 
-    # Check if the TARGET dataframe contains the UTM fields: 'northing_utm [m]' and 'easting_utm [m]'
-    if 'northing_utm [m]' not in df_target.columns:
-        print ("TARGET file does not contain the northing_utm [m] field.")
-        exit()
-    if 'easting_utm [m]' not in df_target.columns:
-        print ("TARGET file does not contain the easting_utm [m] field.")
-        exit()
+    # Both layers must be projected in the same UTM zone, otherwise the distances between them are meaningless
+    zone = args.zone
+    if zone is not None:
+        try:
+            parse_zone(zone)
+        except ValueError as e:
+            print (e.args[0])
+            exit()
+    elif source_utm or target_utm:
+        if not has_latlon(df_source.columns):
+            print ("The SOURCE UTM coordinates are used, but their zone is unknown. Provide the UTM zone of the SOURCE layer with --zone to compute the TARGET UTM coordinates.")
+            exit()
+        zone = central_zone(df_source['latitude [deg]'], df_source['longitude [deg]'])
+    if source_utm:
+        print ("Computing SOURCE UTM coordinates from latitude and longitude (zone " + zone + ")")
+        add_utm_columns(df_source, zone)
+    if target_utm:
+        print ("TARGET UTM coordinates will be computed from latitude and longitude (zone " + zone + ")")
     
-    # The sampler algorithm (for now) consists in the closest match using the euclidean distance between the UTM coordinates
+    # The sampler algorithm finds the closest matches using the euclidean distance between the UTM coordinates
     # The distance parameter is used to filter out the matches that are too far away. If distance < 0.0 then no filtering is applied
-    # The algorithm will iterate over the TARGET entries and find the closest match in the SOURCE entries. The mapping is unidirectional so the direction matters
+    # The mapping is unidirectional (TARGET entries are matched against SOURCE entries) so the direction matters
     # Then, append the SOURCE entry to the TARGET entry. If the key is provided, then only the fields that match the key will be appended. If the key is None, then all the fields will be appended
 
-    # Create a new dataframe to store the results
-    df_results = pd.DataFrame(columns=df_target.columns)
-    # Iterate over the TARGET entries
-    try:
-        # the keys to append are known in advance
-        if args.key is not None:
-            fields_to_append = df_source.filter(regex=args.key + "*").columns
-        else:
-            fields_to_append = df_source.columns
-
-        for index, row in df_target.iterrows():
-            # Print the number of the current entry being processed
-            # print ("Processing TARGET entry: " + str(index))
-            # Calculate the euclidean distance between the current TARGET entry and all the SOURCE entries
-            df_source['distance'] = np.sqrt((df_source['northing_utm [m]'] - row['northing_utm [m]'])**2 + (df_source['easting_utm [m]'] - row['easting_utm [m]'])**2)
-            # Sort the SOURCE entries by distance
-            df_source = df_source.sort_values(by=['distance'])
-            
-            # We check if the distance threshold is met. If args.distance < 0.0, then no filtering is applied
-            # Create a new dataframe with the entries that are within the threshold distance
-            if args.distance < 0.0:
-                df_source_filtered = df_source
-            else:
-                df_source_filtered = df_source[df_source['distance'] < args.distance]
-
-            # If there are no matches, then we skip the entry
-            if df_source_filtered.empty:
-                print ("No match found for TARGET entry: " + str(index))
-                continue
+    # Number of matches per TARGET entry for each mode: closest (1), all (None: every match within the distance), knn (--neighbours),
+    # random (1) and random-k (--neighbours). The random modes query all the candidates within the distance and select among them
+    # per block of TARGET entries (so the candidates of a whole chunk are never held at once). Without distance threshold and with
+    # uniform weighting, every SOURCE entry is a candidate and the selection is drawn directly, without querying the index
+    if args.mode not in SAMPLER_MODES:
+        print ("Sampler mode: [" + args.mode + "] is not implemented. Options are: " + ", ".join(SAMPLER_MODES))
+        exit()
+    if args.mode in ['knn', 'random-k'] and args.neighbours < 1:
+        print ("The number of neighbours must be a positive integer.")
+        exit()
+    random_mode = args.mode in ['random', 'random-k']
+    if args.mode in ['closest', 'random']:
+        k = 1
+    elif args.mode == 'all':
+        k = None
+    else:
+        k = args.neighbours
+    query_k = None if random_mode else k
 
-            # Check args.mode for options: closest, random (uninplemented), all
-            # If mode is closest, then we only append the closest match from df_source_filtered
-            if args.mode == 'closest':
-                # Get the closest match (single entry)
-                closest_match = df_source_filtered.iloc[0]
-                print ("Match found for TARGET entry: " + str(index))
+    if random_mode:
+        if args.seed is None:
+            args.seed = int(np.random.SeedSequence().entropy % 2**32)
+        print ("Random sampler seed: " + str(args.seed))
+        if args.distance < 0.0 and args.weighting != 'uniform':
+            print ("Warning: no distance threshold provided, every SOURCE entry is a candidate for each TARGET entry (the distance weighting evaluates all of them).")
+    draw_uniform = random_mode and args.distance < 0.0 and args.weighting == 'uniform'
+    # Random selection among the candidates of each block of TARGET entries, applied by the index (or its workers)
+    reducer = functools.partial(select_random, k=k, seed=args.seed, weighting=args.weighting) if random_mode else None
 
-                for field in fields_to_append:
-                    row['source_' + field] = closest_match[field]
-                
-                # Add the 'distance' to the 'row' dataframe
-                row['match_distance'] = closest_match['distance']
+    # The grid cell defaults to the distance threshold, so each query only visits the 3x3 cells around the TARGET entry
+    cell_size = args.cellsize
+    if cell_size is None and args.distance > 0.0:
+        cell_size = args.distance
 
+    # the keys to append are known in advance
+    # If the key is provided, then only the fields that match the key will be appended. If the key is None, then all the fields will be appended
+    if args.key is not None:
+        fields_to_append = df_source.filter(regex=args.key + "*").columns
+    else:
+        fields_to_append = df_source.columns
 
-                # Append the TARGET entry to the results dataframe
-                df_results = pd.concat([df_results, row.to_frame().T], ignore_index=True)
+    # Build the spatial index over the SOURCE entries. It is built once and shared by all the TARGET chunks
+    # With more than one worker, the TARGET entries of each chunk are split in shards queried in parallel by a pool of processes
+    if draw_uniform:
+        print ("Uniform random selection among all the SOURCE entries, no spatial index required")
+        index = None
+    else:
+        print ("Building [" + args.index + "] spatial index for " + str(len(df_source)) + " SOURCE entries")
+        if args.workers > 1:
+            print ("Using " + str(args.workers) + " worker processes")
+            index = IndexPool(df_source['northing_utm [m]'].to_numpy(), df_source['easting_utm [m]'].to_numpy(),
+                              backend=args.index, cell_size=cell_size, workers=args.workers)
+        else:
+            index = build_index(df_source['northing_utm [m]'].to_numpy(), df_source['easting_utm [m]'].to_numpy(),
+                                backend=args.index, cell_size=cell_size)
 
-            elif args.mode == 'all':
-                # Append all the matches from df_source_filtered to the TARGET entry
-                n = len(df_source_filtered.index)
-                print ("Appending [" + str(n) + "] matches from SOURCE to TARGET: " + str (index))
-                # Iterate over the matches
-                for index, match in df_source_filtered.iterrows():
-                    # If the key is provided, then only the fields that match the key will be appended. If the key is None, then all the fields will be appended
-                    for field in fields_to_append:
-                        row['source_' + field] = match[field]
+    # Read the input TARGET file as a pandas dataframe, skipping the entries already processed when resuming
+    # In streaming mode (--chunksize) the TARGET file is read and processed in chunks of --chunksize entries
+    if args.chunksize is None:
+        target_chunks = [read_table(args.target).iloc[args.resume:]]
+    else:
+        target_chunks = iter_table(args.target, args.chunksize, skiprows=args.resume)
 
-                    # Add the 'distance' to the 'row' dataframe
-                    row['match_distance'] = match['distance']
+    # Query the TARGET entries of each chunk and write the matches straight to the output file
+    # The output is always consistent on disk: a chunk is written only once all its TARGET entries have been processed
+    print ("Saving results to: " + args.output)
+    rows_done = args.resume
+    total_targets = 0
+    total_matched = 0
+    total_matches = 0
+    writer = TableWriter(args.output, append=append_output)
+    try:
+        for df_target in target_chunks:
+            if target_utm:
+                add_utm_columns(df_target, zone)
+            if draw_uniform:
+                target_idx, source_idx, distance = select_uniform(df_target['northing_utm [m]'].to_numpy(),
+                                                                  df_target['easting_utm [m]'].to_numpy(),
+                                                                  df_source['northing_utm [m]'].to_numpy(),
+                                                                  df_source['easting_utm [m]'].to_numpy(),
+                                                                  k, args.seed, target_offset=rows_done)
+            else:
+                # In the random modes, the reducer selects among the candidates. The TARGET row number makes the selection
+                # independent of the chunk size
+                target_idx, source_idx, distance = index.query(df_target['northing_utm [m]'].to_numpy(),
+                                                               df_target['easting_utm [m]'].to_numpy(),
+                                                               k=query_k, max_distance=args.distance,
+                                                               reducer=reducer, target_offset=rows_done)
 
-                    # Append the TARGET entry to the results dataframe
-                    df_results = pd.concat([df_results, row.to_frame().T], ignore_index=True)
+            # Build the output table in one go from the match arrays (TARGET rows, SOURCE fields and distances)
+            df_results = assemble_results(df_target, df_source, fields_to_append, target_idx, source_idx, distance)
+            writer.write(df_results)
 
+            n_matched = len(np.unique(target_idx))
+            rows_done += len(df_target)
+            total_targets += len(df_target)
+            total_matched += n_matched
+            total_matches += len(target_idx)
+            if args.chunksize is not None:
+                print ("Processed TARGET entries: " + str(rows_done) + " (" + str(len(target_idx)) + " matches in the last chunk)")
 
         # Interrupt the execution if the SIGNAL was received
     except KeyboardInterrupt:
         print("Search interrupted by user (CTRL + C)")
+        print("The output contains the results for the first [" + str(rows_done) + "] TARGET entries. Use --resume " + str(rows_done) + " to continue.")
+    finally:
+        writer.close()
+        # Release the worker processes (if any)
+        if isinstance(index, IndexPool):
+            index.close()
 
-    # Save the results dataframe to the provided output file
-    print ("Saving results to: " + args.output)
-    df_results.to_csv(args.output, index=False)
+    print ("Matches found for " + str(total_matched) + " TARGET entries (" + str(total_matches) + " matches in total)")
+    print ("No match found for " + str(total_targets - total_matched) + " TARGET entries")
 
 # Add main as the entry point for the script
 if __name__ == "__main__":
@@ -1,45 +1,517 @@
 import argparse
 import pandas as pd
 import numpy as np
-from scipy.stats import kurtosis, skew
+import os
 
-def calculate_statistics(data):
-    mean = np.mean(data)
-    variance = np.var(data)
-    std_dev = np.std(data)
-    kurt = kurtosis(data)
-    skewness = skew(data)
-    return mean, variance, std_dev, kurt, skewness
+from latent_io import read_header, read_table, iter_table, write_table
+from geo import add_utm_columns, central_zone, has_latlon, has_utm, parse_zone, NORTHING_COLUMN, EASTING_COLUMN, LATITUDE_COLUMN, LONGITUDE_COLUMN
 
-def main():
+# Quantiles added to the statistics table (one row per input column, e.g. latent dimension) by default
+DEFAULT_QUANTILES = [0.25, 0.5, 0.75]
+# Number of rows read at once when several inputs are combined without --chunksize
+DEFAULT_CHUNKSIZE = 100000
+# Columns with the (lower left) corner of the UTM grid cell of each group in the spatially binned mode
+CELL_COLUMNS = ['cell_northing [m]', 'cell_easting [m]']
+
+
+def quantile_names(quantiles):
+    # Name of the column of each quantile, e.g. 0.25 -> q25, 0.5 -> q50, 0.999 -> q99.9
+    return ['q' + ('%g' % (100 * q)) for q in quantiles]
+
+
+def shape_statistics(mean, m2, m3, m4):
+    """
+    Skewness and (Fisher, excess) kurtosis from the central moments, as computed by scipy.stats skew and kurtosis (biased estimators).
+    Constant columns (variance negligible with respect to the mean, as in scipy) have NaN skewness and kurtosis.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skewness = m3 / m2 ** 1.5
+        kurt = m4 / m2 ** 2 - 3.0
+        constant = ~(m2 > (np.finfo(np.float64).eps * mean) ** 2)
+    skewness[constant] = np.nan
+    kurt[constant] = np.nan
+    return kurt, skewness
+
+
+def block_moments(data):
+    """
+    Count, mean and central moment sums (M2, M3, M4) of every column of a 2-D block, ignoring NaN values.
+    The sums are computed from the deviations to the mean of the block (two passes over the block, numerically stable).
+
+    Outputs:
+    - count, mean, m2, m3, m4, nan_mask: arrays with one value per column, and the NaN mask of the block.
+    """
+    nan_mask = np.isnan(data)
+    has_nan = nan_mask.any()
+    count = data.shape[0] - nan_mask.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total = np.nansum(data, axis=0) if has_nan else data.sum(axis=0)
+        mean = np.where(count > 0, total / count, 0.0)
+    # Central moments of all the columns, computed from the same deviations
+    deviation = data - mean
+    if has_nan:
+        deviation[nan_mask] = 0.0
+    squared = deviation * deviation
+    m2 = squared.sum(axis=0)
+    m3 = np.einsum('ij,ij->j', squared, deviation)
+    m4 = np.einsum('ij,ij->j', squared, squared)
+    return count, mean, m2, m3, m4, nan_mask
+
+
+class MomentAccumulator:
+    """
+    Streaming accumulator of the statistics of every column (count, mean, central moments up to the fourth, min, max, NaN count).
+    Blocks of rows are added with update and accumulators of different chunks or shards are combined with merge, using the pairwise
+    update formulas of Chan et al. (extended to the third and fourth moments by Pebay), which are numerically stable. The final
+    statistics do not depend on how the data was split, and match scipy skew and kurtosis to rounding error.
+    NaN values are ignored.
+    """
+
+    def __init__(self, num_columns):
+        # num_columns can also be a shape, e.g. (groups, columns) to keep the statistics of every column of several groups
+        self.count = np.zeros(num_columns, dtype=np.int64)
+        self.mean = np.zeros(num_columns)
+        self.m2 = np.zeros(num_columns)
+        self.m3 = np.zeros(num_columns)
+        self.m4 = np.zeros(num_columns)
+        self.min = np.full(num_columns, np.inf)
+        self.max = np.full(num_columns, -np.inf)
+        self.nan_count = np.zeros(num_columns, dtype=np.int64)
+
+    def update(self, data):
+        """Add a 2-D block of rows (one column per variable)."""
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        block = MomentAccumulator(data.shape[1])
+        if data.shape[0] > 0:
+            block.count, block.mean, block.m2, block.m3, block.m4, nan_mask = block_moments(data)
+            block.nan_count = nan_mask.sum(axis=0)
+            if block.nan_count.any():
+                block.min = np.where(nan_mask, np.inf, data).min(axis=0)
+                block.max = np.where(nan_mask, -np.inf, data).max(axis=0)
+            else:
+                block.min = data.min(axis=0)
+                block.max = data.max(axis=0)
+        return self.merge(block)
+
+    def merge(self, other, rows=None):
+        """
+        Combine the statistics of another accumulator (e.g. of another chunk or shard) into this one.
+        With rows, other only holds some groups of an accumulator of shape (groups, columns): its groups are merged into the
+        groups rows (distinct indices) of this one and the other groups are left untouched.
+        """
+        if rows is not None:
+            # Merge into a copy of the selected groups only, so that the cost follows the size of other
+            part = self.subset(rows).merge(other)
+            for name in ['count', 'mean', 'm2', 'm3', 'm4', 'min', 'max', 'nan_count']:
+                getattr(self, name)[rows] = getattr(part, name)
+            return self
+        na = self.count.astype(np.float64)
+        nb = other.count.astype(np.float64)
+        n = na + nb
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = other.mean - self.mean
+            mean = self.mean + delta * nb / n
+            m2 = self.m2 + other.m2 + delta ** 2 * na * nb / n
+            m3 = (self.m3 + other.m3 + delta ** 3 * na * nb * (na - nb) / n ** 2
+                  + 3 * delta * (na * other.m2 - nb * self.m2) / n)
+            m4 = (self.m4 + other.m4 + delta ** 4 * na * nb * (na ** 2 - na * nb + nb ** 2) / n ** 3
+                  + 6 * delta ** 2 * (na ** 2 * other.m2 + nb ** 2 * self.m2) / n ** 2
+                  + 4 * delta * (na * other.m3 - nb * self.m3) / n)
+        # Columns empty on one side keep the statistics of the other side as they are
+        for name, value in [('mean', mean), ('m2', m2), ('m3', m3), ('m4', m4)]:
+            value = np.where(nb == 0, getattr(self, name), np.where(na == 0, getattr(other, name), value))
+            setattr(self, name, value)
+        self.count = self.count + other.count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.nan_count = self.nan_count + other.nan_count
+        return self
+
+    def subset(self, rows):
+        """Copy of the groups (rows) rows of an accumulator of shape (groups, columns)."""
+        part = MomentAccumulator(0)
+        for name in ['count', 'mean', 'm2', 'm3', 'm4', 'min', 'max', 'nan_count']:
+            setattr(part, name, getattr(self, name)[rows].copy())
+        return part
+
+    def grow(self, num_groups):
+        """Add empty groups (rows) at the end of an accumulator of shape (groups, columns), up to num_groups groups."""
+        extra = MomentAccumulator((num_groups - self.count.shape[0],) + self.count.shape[1:])
+        for name in ['count', 'mean', 'm2', 'm3', 'm4', 'min', 'max', 'nan_count']:
+            setattr(self, name, np.concatenate([getattr(self, name), getattr(extra, name)]))
+        return self
+
+    def finalize(self):
+        """
+        Statistics of every column: dictionary with an array for each of mean, variance, std_dev, kurtosis, skewness, min, max and
+        nan_count. Columns without values are NaN.
+        """
+        empty = self.count == 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(empty, np.nan, self.mean)
+            m2 = self.m2 / self.count
+            m3 = self.m3 / self.count
+            m4 = self.m4 / self.count
+        kurt, skewness = shape_statistics(mean, m2, m3, m4)
+        return {
+            'mean': mean,
+            'variance': m2,
+            'std_dev': np.sqrt(m2),
+            'kurtosis': kurt,
+            'skewness': skewness,
+            'min': np.where(empty, np.nan, self.min),
+            'max': np.where(empty, np.nan, self.max),
+            'nan_count': self.nan_count,
+        }
+
+
+def grouped_moments(data, codes, num_groups):
+    """
+    Statistics of every column of a 2-D block for each group of rows, in one vectorized pass: the rows are sorted by group and
+    every statistic is reduced over the contiguous rows of each group.
+
+    Inputs:
+    - data: 2-D float64 array (rows are entries, columns are variables).
+    - codes: array with the group (0 to num_groups - 1) of each row.
+    - num_groups: total number of groups (groups without rows are empty).
+
+    Outputs:
+    - accumulator: MomentAccumulator of shape (num_groups, columns).
+    """
+    accumulator = MomentAccumulator((num_groups, data.shape[1]))
+    if data.shape[0] == 0:
+        return accumulator
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    data = data[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    groups = codes[starts]
+    lengths = np.diff(np.r_[starts, len(codes)])
+
+    nan_mask = np.isnan(data)
+    values = np.where(nan_mask, 0.0, data)
+    count = np.add.reduceat(~nan_mask, starts, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, np.add.reduceat(values, starts, axis=0) / count, 0.0)
+    # Central moments of all the columns and groups, from the deviations to the mean of each group
+    deviation = values - np.repeat(mean, lengths, axis=0)
+    deviation[nan_mask] = 0.0
+    squared = deviation * deviation
+    accumulator.count[groups] = count
+    accumulator.mean[groups] = mean
+    accumulator.m2[groups] = np.add.reduceat(squared, starts, axis=0)
+    accumulator.m3[groups] = np.add.reduceat(squared * deviation, starts, axis=0)
+    accumulator.m4[groups] = np.add.reduceat(squared * squared, starts, axis=0)
+    accumulator.min[groups] = np.minimum.reduceat(np.where(nan_mask, np.inf, data), starts, axis=0)
+    accumulator.max[groups] = np.maximum.reduceat(np.where(nan_mask, -np.inf, data), starts, axis=0)
+    accumulator.nan_count[groups] = np.add.reduceat(nan_mask, starts, axis=0)
+    return accumulator
+
+
+class GroupedStatistics:
+    """
+    Streaming statistics of every column for each group of rows. Groups are given by one or more key columns (e.g. dive id, label
+    class, UTM grid cell) and are discovered chunk after chunk.
+    """
+
+    def __init__(self, num_columns, key_names):
+        self.key_names = list(key_names)
+        self.keys = None
+        self.accumulator = MomentAccumulator((0, num_columns))
+
+    def update(self, data, keys):
+        """
+        Add a 2-D block of rows (one column per variable) with the dataframe of the group keys of each row.
+        Rows with a missing (NaN) key are ignored.
+
+        Outputs:
+        - dropped: number of ignored rows.
+        """
+        valid = keys.notna().all(axis=1).to_numpy()
+        keys = pd.MultiIndex.from_frame(keys[valid])
+        codes, uniques = pd.factorize(keys)
+        # Map the groups of the chunk to the groups seen so far, adding the new ones
+        if self.keys is None:
+            self.keys = uniques
+            positions = np.arange(len(uniques))
+        else:
+            positions = self.keys.get_indexer(uniques)
+            new = positions < 0
+            if new.any():
+                positions[new] = len(self.keys) + np.arange(new.sum())
+                self.keys = self.keys.append(uniques[new])
+        # The accumulator keeps spare groups, doubling its size when full, so that adding groups does not copy it on every chunk
+        capacity = self.accumulator.count.shape[0]
+        if len(self.keys) > capacity:
+            self.accumulator.grow(max(len(self.keys), 2 * capacity))
+        # Reduce the chunk over its own groups only, so that the cost does not grow with the number of groups seen so far
+        chunk = grouped_moments(np.asarray(data, dtype=np.float64)[valid], codes, len(uniques))
+        self.accumulator.merge(chunk, rows=positions)
+        return int((~valid).sum())
+
+    def table(self, columns):
+        """
+        Statistics table: one row per group and column, with the key columns first, sorted by key.
+        """
+        num_groups = len(self.keys) if self.keys is not None else 0
+        accumulator = self.accumulator.subset(slice(0, num_groups))
+        stats = dict(count=accumulator.count, **accumulator.finalize())
+        order = self.keys.argsort() if num_groups > 0 else np.arange(0)
+        statistics_df = pd.DataFrame({name: values[order].ravel() for name, values in stats.items()})
+        statistics_df.insert(0, 'latent', np.tile(np.asarray(columns, dtype=object), num_groups))
+        for i, name in enumerate(self.key_names):
+            level = self.keys.get_level_values(i)[order] if num_groups > 0 else []
+            statistics_df.insert(i, name, np.repeat(np.asarray(level), len(columns)))
+        return statistics_df
+
+
+def group_keys(df, group_columns=None, cell_size=None, zone=None):
+    """
+    Dataframe with the group keys of each row: the group columns and, with a cell size, the corner of the UTM grid cell of the row.
+    If the rows do not have UTM coordinates, they are computed from latitude and longitude in the given zone.
+    """
+    keys = pd.DataFrame(index=df.index)
+    for column in group_columns or []:
+        keys[column] = df[column]
+    if cell_size is not None:
+        if not has_utm(df.columns):
+            df = df[[LATITUDE_COLUMN, LONGITUDE_COLUMN]].copy()
+            add_utm_columns(df, zone)
+        keys[CELL_COLUMNS[0]] = np.floor(df[NORTHING_COLUMN].to_numpy(dtype=np.float64) / cell_size) * cell_size
+        keys[CELL_COLUMNS[1]] = np.floor(df[EASTING_COLUMN].to_numpy(dtype=np.float64) / cell_size) * cell_size
+    return keys
+
+
+def calculate_statistics(data, quantiles=DEFAULT_QUANTILES):
+    """
+    Calculate the statistics of every column of a 2-D block of data at once.
+
+    Inputs:
+    - data: 2-D array (rows are entries, columns are variables, e.g. latent dimensions). It is upcast to float64.
+    - quantiles: list of quantiles (0 to 1) to compute. Empty list to skip them.
+
+    Outputs:
+    - stats: dictionary with an array (one value per column) for each statistic: mean, variance, std_dev, kurtosis, skewness, min,
+      max, nan_count and the quantiles (q25, q50, ...). NaN values are ignored.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    accumulator = MomentAccumulator(data.shape[1]).update(data)
+    stats = accumulator.finalize()
+
+    if len(quantiles) > 0:
+        # All the quantiles come from a single sort of each column (NaN values are sorted last)
+        columns = np.ascontiguousarray(data.T)
+        columns.sort(axis=1)
+        for name, value in zip(quantile_names(quantiles), sorted_quantiles(columns, accumulator.count, quantiles)):
+            stats[name] = value
+    return stats
+
+
+def sorted_quantiles(columns, count, quantiles):
+    """
+    Quantiles of each row of a sorted 2-D array, with the linear interpolation of numpy.quantile.
+
+    Inputs:
+    - columns: 2-D array with one sorted variable per row (NaN values last).
+    - count: number of valid (not NaN) values of each row.
+    - quantiles: list of quantiles (0 to 1).
+
+    Outputs:
+    - values: 2-D array (quantiles x rows). Rows without valid values are NaN.
+    """
+    rows = np.arange(columns.shape[0])
+    values = np.full((len(quantiles), columns.shape[0]), np.nan)
+    valid = count > 0
+    last = np.maximum(count - 1, 0)
+    for i, q in enumerate(quantiles):
+        position = q * last
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, last)
+        t = position - low
+        a = columns[rows[valid], low[valid]]
+        b = columns[rows[valid], high[valid]]
+        t = t[valid]
+        # Same interpolation as numpy (from the closest end, for accuracy)
+        values[i, valid] = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    return values
+
+
+def statistics_table(columns, stats):
+    """
+    Build the statistics table (one row per column) from the dictionary returned by calculate_statistics.
+    """
+    statistics_df = pd.DataFrame(stats)
+    statistics_df.insert(0, 'latent', list(columns))
+    return statistics_df
+
+
+def numeric_columns(path):
+    # Numerical columns of a table, from its first rows (the whole table is not read)
+    for df in iter_table(path, 1000):
+        return df.select_dtypes(include='number').columns, df.columns
+    df = read_table(path)
+    return df.select_dtypes(include='number').columns, df.columns
+
+
+def accumulate_file(path, columns, chunksize):
+    """
+    Accumulate the statistics of the given columns of a table, reading it in chunks of rows.
+
+    Outputs:
+    - accumulator: MomentAccumulator with the statistics of the table.
+    """
+    accumulator = MomentAccumulator(len(columns))
+    for df in iter_table(path, chunksize, columns=list(columns)):
+        accumulator.update(df[columns].to_numpy(dtype=np.float64))
+    return accumulator
+
+
+def grouped_statistics(args):
+    """
+    Statistics of every column for each group (--group columns and/or UTM grid cell of --cellsize), accumulated over all the inputs.
+
+    Outputs:
+    - statistics_df: statistics table, one row per group and column.
+    - columns: columns whose statistics are calculated.
+    - all_columns: all the columns of the (first) input.
+    """
+    header = read_header(args.input[0])
+    group_columns = args.group or []
+    missing = [column for column in group_columns if column not in header]
+    if len(missing) > 0:
+        print ('Group column(s) not found in the input: ' + ', '.join(missing))
+        exit()
+
+    # Georeferencing columns used to bin the entries
+    zone = args.zone
+    georef_columns = []
+    if args.cellsize is not None:
+        if has_utm(header):
+            georef_columns = [NORTHING_COLUMN, EASTING_COLUMN]
+        elif has_latlon(header):
+            georef_columns = [LATITUDE_COLUMN, LONGITUDE_COLUMN]
+            if zone is None:
+                first = next(iter_table(args.input[0], DEFAULT_CHUNKSIZE, columns=georef_columns))
+                zone = central_zone(first[LATITUDE_COLUMN], first[LONGITUDE_COLUMN])
+            else:
+                try:
+                    parse_zone(zone)
+                except ValueError as e:
+                    print (e.args[0])
+                    exit()
+            print ('UTM coordinates computed from latitude and longitude (zone ' + zone + ')')
+        else:
+            print ('The input does not have UTM (northing_utm [m], easting_utm [m]) nor latitude and longitude columns to bin the entries.')
+            exit()
+
+    # Statistics are calculated for the numerical columns, except the group keys and the georeferencing columns (in grid mode)
+    numeric, all_columns = numeric_columns(args.input[0])
+    excluded = set(group_columns)
+    if args.cellsize is not None:
+        excluded.update([NORTHING_COLUMN, EASTING_COLUMN, LATITUDE_COLUMN, LONGITUDE_COLUMN])
+    columns = [column for column in numeric if column not in excluded]
+    read_columns = columns + [column for column in group_columns + georef_columns if column not in columns]
+
+    key_names = group_columns + (CELL_COLUMNS if args.cellsize is not None else [])
+    print ('Calculating statistics per group: ' + ', '.join(key_names))
+    statistics = GroupedStatistics(len(columns), key_names)
+    dropped = 0
+    for filename in args.input:
+        missing = [column for column in read_columns if column not in read_header(filename)]
+        if len(missing) > 0:
+            print ('Input file: [' + filename + '] does not have the columns: ' + ', '.join(map(str, missing)))
+            exit()
+        if args.chunksize is None and len(args.input) == 1:
+            chunks = [read_table(filename, columns=read_columns)]
+        else:
+            chunks = iter_table(filename, args.chunksize or DEFAULT_CHUNKSIZE, columns=read_columns)
+        for df in chunks:
+            dropped += statistics.update(df[columns].to_numpy(dtype=np.float64), group_keys(df, group_columns, args.cellsize, zone))
+    if dropped > 0:
+        print ('Skipped ' + str(dropped) + ' entries without group key (or coordinates)')
+    print ('Number of groups: ' + str(0 if statistics.keys is None else len(statistics.keys)))
+    return statistics.table(columns), columns, [column for column in all_columns if column not in excluded]
+
+
+def main(args=None):
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Calculate summary statistics for a CSV file.')
-    parser.add_argument('--input', type=str, help='Input CSV file name')
+    parser.add_argument('--input', type=str, nargs='+', help='Input CSV file name (Parquet, Feather and NPY files are also accepted). Several files (shards) can be provided, their statistics are combined')
     parser.add_argument('--output', type=str, default=None, help='Output CSV file name (default: stats_input.csv)')
-    args = parser.parse_args()
+    parser.add_argument('--quantiles', type=float, nargs='*', default=DEFAULT_QUANTILES,
+                        help='Quantiles (0 to 1) added to the statistics (default: 0.25 0.5 0.75). Provide no values to skip them. Only available for a single input processed in memory')
+    parser.add_argument('--chunksize', '-c', type=int, default=None,
+                        help='Read the input in chunks of this number of rows and accumulate the statistics, so files larger than the memory can be processed. Default: read the whole input at once')
+    # Grouped and spatially binned statistics
+    parser.add_argument('--group', '-g', type=str, nargs='+', default=None,
+                        help='Column(s) whose values define groups of entries (e.g. dive id, label class). The statistics are calculated for each group')
+    parser.add_argument('--cellsize', type=float, default=None,
+                        help='Size [m] of the cells of a UTM grid (northing_utm [m], easting_utm [m]). The statistics are calculated for each grid cell (and group, if --group is provided)')
+    parser.add_argument('--zone', '-z', type=str, default=None,
+                        help='UTM zone (e.g. 30N) used to compute the UTM coordinates when the input only has latitude and longitude (--cellsize). Default: the zone of the centre of the first rows')
+    args = parser.parse_args(args)
+
+    if any(q < 0 or q > 1 for q in args.quantiles):
+        print ('Quantiles must be between 0 and 1.')
+        exit()
+    if args.chunksize is not None and args.chunksize < 1:
+        print ('The chunk size must be a positive integer.')
+        exit()
+    for filename in args.input:
+        if not os.path.isfile(filename):
+            print ('Provided input file: [' + filename + '] not found.')
+            exit()
+    if args.cellsize is not None and args.cellsize <= 0:
+        print ('The cell size must be a positive number.')
+        exit()
+
+    grouped = args.group is not None or args.cellsize is not None
+    if grouped:
+        statistics_df, columns, all_columns = grouped_statistics(args)
+    elif args.chunksize is None and len(args.input) == 1:
+        # Load the CSV data into a DataFrame, using the first row as the header
+        df = read_table(args.input[0])
+
+        # Statistics are calculated for the numerical columns only
+        columns = df.select_dtypes(include='number').columns
+        all_columns = df.columns
 
-    # Load the CSV data into a DataFrame, using the first row as the header
-    df = pd.read_csv(args.input, header=0)
+        # Calculate all the statistics for every column at once, from a single 2-D float64 block
+        stats = calculate_statistics(df[columns].to_numpy(dtype=np.float64), args.quantiles)
+    else:
+        # Statistics are calculated for the numerical columns only. All the inputs must have them
+        columns, all_columns = numeric_columns(args.input[0])
+        if len(args.quantiles) > 0:
+            print ('Quantiles are not computed in streaming (--chunksize) or multiple input mode.')
+        accumulator = MomentAccumulator(len(columns))
+        for filename in args.input:
+            missing = [column for column in columns if column not in read_header(filename)]
+            if len(missing) > 0:
+                print ('Input file: [' + filename + '] does not have the columns: ' + ', '.join(map(str, missing)))
+                exit()
+            # Each input is accumulated chunk by chunk, and the statistics of the inputs are merged
+            print ('Accumulating statistics of: ' + filename)
+            accumulator.merge(accumulate_file(filename, columns, args.chunksize or DEFAULT_CHUNKSIZE))
+        stats = accumulator.finalize()
 
-    # Create a new DataFrame for statistics
-    statistics_df = pd.DataFrame(columns=['latent'] + ['mean', 'variance', 'std_dev', 'kurtosis', 'skewness'])
+    skipped = [column for column in all_columns if column not in columns]
+    if len(skipped) > 0:
+        print ('Skipped non-numerical columns: ' + ', '.join(map(str, skipped)))
 
-    # Calculate statistics for each column and add a row for each statistic
-    # Iterate over each column in the DataFrame, retrieve the header and data
-    for column in df.columns:
-        column_data = df[column]
-        stats = calculate_statistics(column_data)
-        print ("-------------------")
-        print (column)
-        print (stats)
-        statistics_df.loc[len(statistics_df)] = [column] + list(stats)
+    if not grouped:
+        statistics_df = statistics_table(columns, stats)
+    print (statistics_df)
 
     # Define the output file name
     if args.output is None:
-        args.output = 'stats_' + args.input
+        args.output = 'stats_' + os.path.splitext(args.input[0])[0] + '.csv'
 
     # Export the statistics to a CSV file
-    statistics_df.to_csv(args.output, index=False)
+    write_table(statistics_df, args.output)
 
 if __name__ == "__main__":
     main()
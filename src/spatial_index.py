@@ -0,0 +1,508 @@
+# spatial_index.py
+
+# Description: Spatial index used by latent_sampler to match TARGET entries against SOURCE entries using UTM coordinates
+# The index is built once over the SOURCE coordinates (northing, easting) and answers the queries for all the TARGET entries in a single batched call
+# Three backends are provided:
+#   - 'kdtree': KD-tree based on scipy.spatial.cKDTree (default, requires scipy)
+#   - 'grid':   uniform grid of square buckets (pure numpy)
+#   - 'brute':  exhaustive scan of all SOURCE entries for every TARGET entry (reference mode, identical to the original latent_sampler loop)
+# The queries can be distributed over a pool of worker processes with IndexPool. The SOURCE coordinates are shared with the workers
+# through shared memory, and each worker builds its own copy of the index once at start-up
+
+# All the backends return the same results: matches are sorted per TARGET entry by distance and ties are broken by the SOURCE row position.
+# The distance is always computed as sqrt(dn**2 + de**2) over the float64 coordinates, so the values are identical between backends.
+# The distance threshold is strict (distance < max_distance), and a negative threshold disables the filtering.
+# Entries with non-finite coordinates (e.g. NaN UTM values of entries without latitude and longitude) never match: the index is built
+# over the finite SOURCE entries only (results are given in the original SOURCE positions), and non-finite TARGET entries have no matches.
+# With k set, the backends only retrieve the k nearest candidates (within the distance threshold, if any), so the memory used by a
+# closest or k nearest query does not depend on the density of the SOURCE entries.
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Available backends for the spatial index
+INDEX_BACKENDS = ['kdtree', 'grid', 'brute']
+
+# Relative inflation applied to the search radius of the candidate queries. Candidates are always re-filtered with the exact distance,
+# so we only need the candidate set to be a superset of the final result (this absorbs rounding differences between backends)
+_RADIUS_SLACK = 1e-9
+
+
+def _pair_distance(src_n, src_e, tgt_n, tgt_e, target_idx, source_idx):
+    """
+    Compute the euclidean distance for a list of (target, source) pairs.
+
+    Inputs:
+    - src_n, src_e: SOURCE northing and easting arrays of size M.
+    - tgt_n, tgt_e: TARGET northing and easting arrays of size N.
+    - target_idx, source_idx: arrays of size P with the position of each pair in the TARGET and SOURCE arrays.
+
+    Outputs:
+    - distance: array of size P with the euclidean distance of each pair.
+    """
+    return np.sqrt((src_n[source_idx] - tgt_n[target_idx])**2 + (src_e[source_idx] - tgt_e[target_idx])**2)
+
+
+def _expand_ranges(starts, counts):
+    """
+    Expand a set of [start, start + count) ranges into a flat array of positions.
+
+    Inputs:
+    - starts: array with the first position of each range.
+    - counts: array with the length of each range.
+
+    Outputs:
+    - positions: flat array with the concatenation of all the ranges.
+    """
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+class SpatialIndex:
+    """
+    Base class of the spatial index over the SOURCE UTM coordinates.
+
+    Backends provide the candidate pairs (a superset of the real matches) and this class computes the exact distances,
+    applies the distance threshold, sorts the matches and keeps the k nearest when requested.
+    """
+
+    # Maximum number of (target, source) pairs evaluated at once when a full scan is required
+    block_pairs = 2**22
+    # True if the backend evaluates every SOURCE entry for each TARGET entry
+    scans_all = False
+
+    def __init__(self, northing, easting):
+        northing = np.ascontiguousarray(northing, dtype=np.float64)
+        easting = np.ascontiguousarray(easting, dtype=np.float64)
+        # Only the finite SOURCE entries are indexed. rows maps the positions in the index to the original SOURCE positions
+        # (None if all the entries are finite)
+        finite = np.isfinite(northing) & np.isfinite(easting)
+        if finite.all():
+            self.rows = None
+        else:
+            self.rows = np.flatnonzero(finite)
+            northing, easting = northing[self.rows], easting[self.rows]
+        self.northing = northing
+        self.easting = easting
+        self.size = len(self.northing)
+
+    def query(self, northing, easting, k=None, max_distance=-1.0, block_size=65536, reducer=None, target_offset=0):
+        """
+        Find the SOURCE entries matching each TARGET entry.
+
+        Inputs:
+        - northing, easting: TARGET coordinates, arrays of size N.
+        - k: maximum number of matches per TARGET entry (k=1 is the closest match). If None, all the matches are returned.
+        - max_distance: distance threshold [m]. Only matches with distance < max_distance are returned. Negative values disable the threshold.
+        - block_size: number of TARGET entries queried at once, it bounds the memory used by the candidate pairs.
+        - reducer: optional function applied to the matches of each block of TARGET entries, reducer(target_idx, source_idx, distance,
+          target_offset=...) -> (target_idx, source_idx, distance). All the matches of a TARGET entry are in the same block, so it can
+          select among them (e.g. a random subset) without holding the matches of all the TARGET entries in memory.
+        - target_offset: row number of the first TARGET entry, passed to the reducer.
+
+        Outputs:
+        - target_idx: array of size P with the TARGET position of each match.
+        - source_idx: array of size P with the SOURCE position of each match.
+        - distance: array of size P with the distance of each match.
+        Matches are sorted by TARGET position, then by distance and then by SOURCE position.
+        TARGET entries with non-finite coordinates have no matches.
+        """
+        tgt_n = np.ascontiguousarray(northing, dtype=np.float64)
+        tgt_e = np.ascontiguousarray(easting, dtype=np.float64)
+        if k is not None and k < 1:
+            raise ValueError("k must be a positive integer or None")
+        targets = np.flatnonzero(np.isfinite(tgt_n) & np.isfinite(tgt_e))
+
+        # When every SOURCE entry is evaluated for each TARGET entry, bound the number of pairs in each block
+        if self.scans_all or (max_distance < 0.0 and (k is None or k >= self.size)):
+            block_size = min(block_size, max(1, self.block_pairs // max(1, self.size)))
+
+        results_t, results_s, results_d = [], [], []
+        for start in range(0, len(targets), block_size):
+            block = targets[start:start + block_size]
+            t, s, d = self._query_block(tgt_n, tgt_e, block, k, max_distance)
+            if self.rows is not None:
+                s = self.rows[s]
+            if reducer is not None:
+                t, s, d = reducer(t, s, d, target_offset=target_offset)
+            results_t.append(t)
+            results_s.append(s)
+            results_d.append(d)
+
+        if not results_t:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        return np.concatenate(results_t), np.concatenate(results_s), np.concatenate(results_d)
+
+    def query_closest(self, northing, easting, max_distance=-1.0):
+        """
+        Find the closest SOURCE entry for each TARGET entry.
+
+        Outputs:
+        - source_idx: array of size N with the SOURCE position of the closest match, -1 if there is no match.
+        - distance: array of size N with the distance to the closest match, NaN if there is no match.
+        """
+        t, s, d = self.query(northing, easting, k=1, max_distance=max_distance)
+        source_idx = np.full(len(northing), -1, dtype=np.int64)
+        distance = np.full(len(northing), np.nan)
+        source_idx[t] = s
+        distance[t] = d
+        return source_idx, distance
+
+    def _query_block(self, tgt_n, tgt_e, block, k, max_distance):
+        # Retrieve the candidate pairs from the backend
+        if self.size == 0 or len(block) == 0:
+            t = s = np.zeros(0, dtype=np.int64)
+        elif k is not None and k < self.size:
+            # The k nearest candidates within the threshold: the number of candidates does not grow with the SOURCE density
+            t, s = self._knn_candidates(tgt_n[block], tgt_e[block], k, max_distance)
+            t = block[t]
+        elif max_distance >= 0.0:
+            t, s = self._radius_candidates(tgt_n[block], tgt_e[block], max_distance * (1.0 + _RADIUS_SLACK))
+            t = block[t]
+        else:
+            # No distance threshold and all the SOURCE entries are requested: every pair is a match
+            t = np.repeat(block, self.size)
+            s = np.tile(np.arange(self.size, dtype=np.int64), len(block))
+
+        # Exact distance and threshold (positions in the index)
+        d = _pair_distance(self.northing, self.easting, tgt_n, tgt_e, t, s)
+        if max_distance >= 0.0:
+            keep = d < max_distance
+            t, s, d = t[keep], s[keep], d[keep]
+
+        # Sort by target, distance and source position (the last key of lexsort is the primary one)
+        order = np.lexsort((s, d, t))
+        t, s, d = t[order], s[order], d[order]
+
+        # Keep the k nearest matches per target
+        if k is not None and len(t) > 0:
+            first = np.r_[True, t[1:] != t[:-1]]
+            group_start = np.maximum.accumulate(np.where(first, np.arange(len(t)), 0))
+            keep = (np.arange(len(t)) - group_start) < k
+            t, s, d = t[keep], s[keep], d[keep]
+
+        return t, s, d
+
+    def _radius_candidates(self, qn, qe, radius):
+        """Return (query, source) pairs containing at least every SOURCE entry within radius of each query."""
+        raise NotImplementedError
+
+    def _knn_candidates(self, qn, qe, k, max_distance=-1.0):
+        """
+        Return (query, source) pairs containing at least the k nearest SOURCE entries of each query (and all their ties).
+        With max_distance >= 0, only the entries within max_distance need to be included.
+        """
+        raise NotImplementedError
+
+
+class BruteForceIndex(SpatialIndex):
+    """
+    Reference backend: every TARGET entry is compared against every SOURCE entry.
+    """
+
+    scans_all = True
+
+    def _all_pairs(self, n_queries):
+        # Evaluate all the pairs, the number of queries per block is bounded by block_pairs
+        t = np.repeat(np.arange(n_queries, dtype=np.int64), self.size)
+        s = np.tile(np.arange(self.size, dtype=np.int64), n_queries)
+        return t, s
+
+    def _radius_candidates(self, qn, qe, radius):
+        return self._all_pairs(len(qn))
+
+    def _knn_candidates(self, qn, qe, k, max_distance=-1.0):
+        return self._all_pairs(len(qn))
+
+
+class KDTreeIndex(SpatialIndex):
+    """
+    KD-tree backend based on scipy.spatial.cKDTree.
+    """
+
+    def __init__(self, northing, easting):
+        super().__init__(northing, easting)
+        if cKDTree is None:
+            raise ImportError("The 'kdtree' backend requires scipy. Use the 'grid' backend instead.")
+        self.tree = cKDTree(np.column_stack((self.northing, self.easting)))
+
+    def _ball_pairs(self, qn, qe, radius):
+        # query_ball_point returns one list of SOURCE positions per query
+        neighbours = self.tree.query_ball_point(np.column_stack((qn, qe)), radius)
+        counts = np.fromiter((len(n) for n in neighbours), dtype=np.int64, count=len(neighbours))
+        t = np.repeat(np.arange(len(qn), dtype=np.int64), counts)
+        if counts.sum() == 0:
+            return t, np.zeros(0, dtype=np.int64)
+        s = np.concatenate([np.asarray(n, dtype=np.int64) for n in neighbours])
+        return t, s
+
+    def _radius_candidates(self, qn, qe, radius):
+        return self._ball_pairs(qn, qe, radius)
+
+    def _knn_candidates(self, qn, qe, k, max_distance=-1.0):
+        # The distance to the k-th neighbour bounds the search radius. Using a ball query with that radius
+        # (instead of the k indices returned by the tree) also captures the entries tied with the k-th neighbour
+        if max_distance >= 0.0:
+            # Neighbours beyond the threshold are not searched (their distance is inf), the radius is capped by the threshold
+            bound = max_distance * (1.0 + _RADIUS_SLACK) + _RADIUS_SLACK
+            dist, _ = self.tree.query(np.column_stack((qn, qe)), k=k, distance_upper_bound=bound)
+            dist = np.minimum(dist.reshape(len(qn), -1)[:, -1], bound)
+        else:
+            dist, _ = self.tree.query(np.column_stack((qn, qe)), k=k)
+            dist = dist.reshape(len(qn), -1)[:, -1]
+        return self._ball_pairs(qn, qe, dist * (1.0 + _RADIUS_SLACK) + _RADIUS_SLACK)
+
+
+class GridIndex(SpatialIndex):
+    """
+    Uniform grid backend. SOURCE entries are bucketed in square cells of size cell_size [m] and the queries
+    only evaluate the entries in the cells surrounding each TARGET entry.
+    """
+
+    def __init__(self, northing, easting, cell_size=None):
+        super().__init__(northing, easting)
+        if self.size == 0:
+            self.origin = np.zeros(2)
+            self.cell_size = 1.0
+            self.shape = (1, 1)
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.starts = self.counts = np.zeros(0, dtype=np.int64)
+            self.order = np.zeros(0, dtype=np.int64)
+            return
+
+        self.origin = np.array([self.northing.min(), self.easting.min()])
+        extent = np.array([self.northing.max(), self.easting.max()]) - self.origin
+        if cell_size is None or cell_size <= 0.0:
+            # Aim for a few SOURCE entries per cell on average
+            area = max(extent[0], 1.0) * max(extent[1], 1.0)
+            cell_size = np.sqrt(4.0 * area / self.size)
+        self.cell_size = float(cell_size)
+        self.shape = tuple((np.floor(extent / self.cell_size).astype(np.int64) + 1).tolist())
+
+        # Sort the SOURCE entries by cell key, and store the first position and the number of entries of each non-empty cell
+        cn, ce = self._cells(self.northing, self.easting)
+        cell_key = cn * self.shape[1] + ce
+        self.order = np.argsort(cell_key, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(cell_key[self.order], return_index=True, return_counts=True)
+
+    def _cells(self, northing, easting):
+        cn = np.floor((northing - self.origin[0]) / self.cell_size).astype(np.int64)
+        ce = np.floor((easting - self.origin[1]) / self.cell_size).astype(np.int64)
+        return cn, ce
+
+    def _ring_pairs(self, qn, qe, reach):
+        """Return the (query, source) pairs for all the entries in the cells within reach (in cells) of each query."""
+        # If the search window covers the whole grid, every SOURCE entry is a candidate
+        if (2 * reach + 1) >= max(self.shape):
+            t = np.repeat(np.arange(len(qn), dtype=np.int64), self.size)
+            s = np.tile(np.arange(self.size, dtype=np.int64), len(qn))
+            return t, s
+
+        cn, ce = self._cells(qn, qe)
+        queries = np.arange(len(qn), dtype=np.int64)
+        results_t, results_s = [], []
+        for dn in range(-reach, reach + 1):
+            for de in range(-reach, reach + 1):
+                n, e = cn + dn, ce + de
+                valid = (n >= 0) & (n < self.shape[0]) & (e >= 0) & (e < self.shape[1])
+                key = n[valid] * self.shape[1] + e[valid]
+                pos = np.searchsorted(self.keys, key)
+                pos = np.minimum(pos, len(self.keys) - 1)
+                found = self.keys[pos] == key
+                counts = self.counts[pos[found]]
+                results_t.append(np.repeat(queries[valid][found], counts))
+                results_s.append(self.order[_expand_ranges(self.starts[pos[found]], counts)])
+        return np.concatenate(results_t), np.concatenate(results_s)
+
+    def _radius_candidates(self, qn, qe, radius):
+        return self._ring_pairs(qn, qe, int(np.ceil(radius / self.cell_size)))
+
+    def _knn_candidates(self, qn, qe, k, max_distance=-1.0):
+        # Grow the search window until every query has at least k entries strictly closer than the window border
+        # (entries outside the window are at least reach * cell_size away from the query, so they cannot be tied with the k-th match)
+        # With a distance threshold, the window stops growing once it covers the threshold
+        if max_distance >= 0.0:
+            max_reach = max(1, int(np.ceil(max_distance * (1.0 + _RADIUS_SLACK) / self.cell_size)))
+        else:
+            max_reach = None
+        pending = np.arange(len(qn), dtype=np.int64)
+        results_t, results_s = [], []
+        reach = 1
+        while len(pending) > 0:
+            if max_reach is not None:
+                reach = min(reach, max_reach)
+            t, s = self._ring_pairs(qn[pending], qe[pending], reach)
+            if (2 * reach + 1) >= max(self.shape) or reach == max_reach:
+                # The window covers the whole grid (or every entry within the threshold), all the pending queries are resolved
+                resolved = np.ones(len(pending), dtype=bool)
+            else:
+                d = np.sqrt((self.northing[s] - qn[pending][t])**2 + (self.easting[s] - qe[pending][t])**2)
+                inside = np.bincount(t[d < reach * self.cell_size], minlength=len(pending))
+                resolved = inside >= k
+            keep = resolved[t]
+            results_t.append(pending[t[keep]])
+            results_s.append(s[keep])
+            pending = pending[~resolved]
+            reach *= 2
+        return np.concatenate(results_t), np.concatenate(results_s)
+
+
+def build_index(northing, easting, backend='kdtree', cell_size=None):
+    """
+    Build a spatial index over the SOURCE coordinates.
+
+    Inputs:
+    - northing, easting: SOURCE coordinates, arrays of size M.
+    - backend: one of 'kdtree', 'grid' or 'brute'.
+    - cell_size: size [m] of the grid cells, only used by the 'grid' backend. If None, it is derived from the density of the SOURCE entries.
+
+    Outputs:
+    - index: SpatialIndex instance.
+    """
+    if backend == 'kdtree':
+        if cKDTree is None:
+            print ("scipy is not available, falling back to the 'grid' spatial index.")
+            return GridIndex(northing, easting, cell_size)
+        return KDTreeIndex(northing, easting)
+    elif backend == 'grid':
+        return GridIndex(northing, easting, cell_size)
+    elif backend == 'brute':
+        return BruteForceIndex(northing, easting)
+    raise ValueError("Unknown spatial index backend: " + str(backend) + ". Options are: " + ", ".join(INDEX_BACKENDS))
+
+
+# Per-process state of the IndexPool workers: the shared memory block with the SOURCE coordinates and the index built over it
+_worker_shm = None
+_worker_index = None
+
+
+def _init_worker(shm_name, size, backend, cell_size):
+    # Attach to the SOURCE coordinates published by the parent process (no copy) and build the index once per worker
+    global _worker_shm, _worker_index
+    _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    coords = np.ndarray((2, size), dtype=np.float64, buffer=_worker_shm.buf)
+    _worker_index = build_index(coords[0], coords[1], backend=backend, cell_size=cell_size)
+
+
+def _query_shard(task):
+    northing, easting, k, max_distance, reducer, target_offset = task
+    return _worker_index.query(northing, easting, k=k, max_distance=max_distance, reducer=reducer, target_offset=target_offset)
+
+
+class IndexPool:
+    """
+    Pool of worker processes answering spatial index queries in parallel.
+
+    The TARGET entries of each query are split in shards that are processed by the workers, and the results are merged
+    back in the original TARGET order, so the output does not depend on the number of workers.
+    It exposes the same query() method as SpatialIndex. Call close() (or use it as a context manager) to release the workers.
+    """
+
+    def __init__(self, northing, easting, backend='kdtree', cell_size=None, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.size = len(northing)
+
+        # Publish the SOURCE coordinates in a shared memory block so they are not pickled for every worker or task
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, 2 * self.size * 8))
+        coords = np.ndarray((2, self.size), dtype=np.float64, buffer=self.shm.buf)
+        coords[0] = northing
+        coords[1] = easting
+
+        self.pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                         initargs=(self.shm.name, self.size, backend, cell_size))
+
+    def query(self, northing, easting, k=None, max_distance=-1.0, shard_size=None, reducer=None, target_offset=0):
+        """
+        Find the SOURCE entries matching each TARGET entry. See SpatialIndex.query for the description of the inputs and outputs.
+
+        Inputs:
+        - shard_size: number of TARGET entries per task. If None, the TARGET entries are split in 4 shards per worker.
+        The reducer (if any) is applied by the workers, so it must be a picklable function (e.g. a functools.partial of a module function).
+        """
+        northing = np.ascontiguousarray(northing, dtype=np.float64)
+        easting = np.ascontiguousarray(easting, dtype=np.float64)
+        if shard_size is None:
+            shard_size = max(1, int(np.ceil(len(northing) / (4 * self.workers))))
+        starts = range(0, len(northing), shard_size)
+        tasks = [(northing[i:i + shard_size], easting[i:i + shard_size], k, max_distance, reducer, target_offset + i) for i in starts]
+
+        # map() returns the shards in submission order, shift the TARGET positions back to the full array
+        results = self.pool.map(_query_shard, tasks)
+        if not results:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        target_idx = np.concatenate([t + start for (t, _, _), start in zip(results, starts)])
+        source_idx = np.concatenate([s for _, s, _ in results])
+        distance = np.concatenate([d for _, _, d in results])
+        return target_idx, source_idx, distance
+
+    def close(self):
+        """Stop the workers and release the shared memory block."""
+        self.pool.terminate()
+        self.pool.join()
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def check_backends(n_source=2000, n_target=500, extent=200.0, n_nan=20, seed=0):
+    """
+    Check that all the backends (and IndexPool) return the same matches as the 'brute' reference search.
+
+    The SOURCE and TARGET entries are random points in a square of size extent [m], with duplicated points (ties) and n_nan
+    entries with NaN coordinates in each set. The queries cover all the matches, the k nearest and the closest match, with and
+    without distance threshold.
+
+    Outputs:
+    - ok: True if all the results are identical.
+    """
+    rng = np.random.default_rng(seed)
+    src = rng.uniform(0.0, extent, (2, n_source))
+    tgt = rng.uniform(0.0, extent, (2, n_target))
+    # Ties: some TARGET entries on top of SOURCE entries, and duplicated SOURCE entries
+    tgt[:, :n_target // 10] = src[:, :n_target // 10]
+    src[:, -n_source // 10:] = src[:, :n_source // 10]
+    for coords in [src, tgt]:
+        rows = rng.choice(coords.shape[1], n_nan, replace=False)
+        coords[rng.integers(0, 2, n_nan), rows] = np.nan
+
+    reference = BruteForceIndex(src[0], src[1])
+    backends = [(name, build_index(src[0], src[1], backend=name)) for name in INDEX_BACKENDS if name != 'brute']
+    backends.append(('grid (cell 1 m)', GridIndex(src[0], src[1], cell_size=1.0)))
+    ok = True
+    with IndexPool(src[0], src[1], backend='kdtree' if cKDTree is not None else 'grid', workers=2) as pool:
+        backends.append(('pool', pool))
+        for k in [None, 1, 3]:
+            for max_distance in [-1.0, 0.0, 5.0, 20.0]:
+                if k is None and max_distance < 0.0:
+                    continue
+                expected = reference.query(tgt[0], tgt[1], k=k, max_distance=max_distance)
+                for name, index in backends:
+                    result = index.query(tgt[0], tgt[1], k=k, max_distance=max_distance)
+                    same = all(np.array_equal(r, e) for r, e in zip(result, expected))
+                    if not same:
+                        print ('Mismatch: backend ' + name + ', k=' + str(k) + ', max_distance=' + str(max_distance))
+                    ok = ok and same
+    return ok
+
+
+if __name__ == '__main__':
+    # Self-check of the backends: python spatial_index.py
+    if check_backends():
+        print ('All the spatial index backends match the brute force reference.')
+    else:
+        exit(1)
@@ -30,65 +30,392 @@ import numpy as np
 
 # This pseudo code assumes that the data points are represented as a matrix X of size N x D, where N is the number of data points and D is the number of dimensions, and that the cluster assignments are stored in a vector C of size N x 1. The output of the algorithm is a vector S of size N x 1, containing the silhouette score for each data point.
 
-def silhouette_analysis(X, C):
+def pairwise_distances(A, B, B_sq_norms=None):
+    """
+    Compute the euclidean distances between the rows of A and the rows of B with a matrix product.
+    
+    Inputs:
+    - A: Data matrix of size M x D.
+    - B: Data matrix of size N x D.
+    - B_sq_norms: Squared norms of the rows of B (optional, to avoid recomputing them for every block of A).
+    
+    Outputs:
+    - dist: Distance matrix of size M x N.
+    """
+    if B_sq_norms is None:
+        B_sq_norms = np.einsum('ij,ij->i', B, B)
+    dist = np.einsum('ij,ij->i', A, A)[:, None] - 2.0 * (A @ B.T)
+    dist += B_sq_norms[None, :]
+    # Rounding can produce small negative values for (almost) coincident points
+    np.maximum(dist, 0.0, out=dist)
+    return np.sqrt(dist, out=dist)
+
+
+def silhouette_analysis(X, C, max_memory=2**28, sample_size=None, seed=None):
     """
     Compute the silhouette score for each data point.
     
+    The points are processed in blocks: the distances from a block of points to all the points are computed with a matrix product,
+    and summed per cluster (the points are sorted by cluster once, so each cluster is a contiguous range of columns).
+    
     Inputs:
     - X: Data matrix of size N x D, where N is the number of data points and D is the number of dimensions.
     - C: Cluster assignments vector of size N x 1, where each element is an integer representing the cluster assignment of the corresponding data point.
+    - max_memory: Approximate memory limit (bytes) of the block of distances. It sets the number of points processed at once.
+    - sample_size: If provided, only the silhouette scores of a random sample of sample_size points are computed (against all the points). The scores of the other points are NaN. Useful for very large N (see silhouette_score).
+    - seed: Seed of the random sample.
     
     Outputs:
-    - S: Silhouette score vector of size N x 1, where each element is the silhouette score of the corresponding data point.
+    - S: Silhouette score vector of size N x 1, where each element is the silhouette score of the corresponding data point. Points in clusters with a single point have a score of 0.
     """
     
+    X = np.asarray(X, dtype=np.float64)
     N = X.shape[0]  # Number of data points
-    S = np.zeros((N,))  # Initialize silhouette score vector
+    S = np.full((N,), np.nan)  # Initialize silhouette score vector
     
-    for i in range(N):
-        # Compute average distance from point i to all other points in its assigned cluster
-        a_i = np.mean(np.linalg.norm(X[C == C[i]] - X[i], axis=1))
+    # Cluster of each point (0 to K-1) and number of points per cluster
+    labels, codes = np.unique(np.asarray(C).ravel(), return_inverse=True)
+    K = len(labels)
+    counts = np.bincount(codes, minlength=K)
+    if K < 2:
+        raise ValueError("The silhouette score requires at least 2 clusters")
+    
+    # Sort the points by cluster: the distances to the points of cluster k are the columns starts[k]:starts[k+1]
+    order = np.argsort(codes, kind='stable')
+    X_sorted = X[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    position = np.empty(N, dtype=np.int64)
+    position[order] = np.arange(N)
+    sq_norms = np.einsum('ij,ij->i', X_sorted, X_sorted)
+    
+    # Points whose score is computed (all of them, or a random sample)
+    if sample_size is not None and sample_size < N:
+        points = np.sort(np.random.default_rng(seed).choice(N, sample_size, replace=False))
+    else:
+        points = np.arange(N)
+    
+    # Number of points per block, so that the block of distances (and its temporary copies) fits in max_memory
+    block_size = max(1, int(max_memory // (3 * 8 * N)))
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        dist = pairwise_distances(X[block], X_sorted, sq_norms)
+        # The distance of each point to itself is excluded (it can be slightly above 0 due to rounding)
+        dist[np.arange(len(block)), position[block]] = 0.0
+        # Sum of the distances from each point of the block to the points of each cluster
+        sums = np.add.reduceat(dist, starts, axis=1)
+        own = codes[block]
+        rows = np.arange(len(block))
         
-        # Compute average distance from point i to all other points in each of the other clusters
-        b_i = np.min([np.mean(np.linalg.norm(X[C == j] - X[i], axis=1)) for j in set(C) - {C[i]}])
+        # Average distance from each point to all other points in its assigned cluster
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = sums[rows, own] / (counts[own] - 1)
+        # Average distance from each point to the points of the closest other cluster
+        means = sums / counts[None, :]
+        means[rows, own] = np.inf
+        b = means.min(axis=1)
         
-        # Compute silhouette score for point i
-        S[i] = (b_i - a_i) / max(a_i, b_i)
+        # Compute silhouette score for the points of the block (0 for points alone in their cluster)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (b - a) / np.maximum(a, b)
+        score[counts[own] == 1] = 0.0
+        S[block] = np.nan_to_num(score, nan=0.0)
     
     return S
 
 
-def k_means(X, K, max_iter=100):
+def silhouette_score(X, C, max_memory=2**28, sample_size=None, seed=None):
+    """
+    Compute the mean silhouette score of a clustering. With sample_size, the mean is approximated with the scores of a random sample of points (see silhouette_analysis).
+    """
+    S = silhouette_analysis(X, C, max_memory=max_memory, sample_size=sample_size, seed=seed)
+    return np.nanmean(S)
+
+
+def nearest_centroids(X, mu, max_memory=2**28):
+    """
+    Assign each data point to its nearest centroid. The points are processed in blocks, the squared distances from a block of points
+    to all the centroids are computed with a matrix product.
+    
+    Inputs:
+    - X: Data matrix of size N x D (can be a memory mapped array, e.g. np.load(filename, mmap_mode='r')).
+    - mu: Cluster centroid matrix of size K x D.
+    - max_memory: Approximate memory limit (bytes) of the block of distances. It sets the number of points processed at once.
+    
+    Outputs:
+    - C: Cluster assignments vector of size N x 1.
+    - d2: Squared distance of each data point to its nearest centroid, vector of size N x 1.
+    """
+    
+    N = X.shape[0]
+    mu = np.asarray(mu, dtype=np.float64)
+    mu_sq_norms = np.einsum('ij,ij->i', mu, mu)
+    C = np.empty((N,), dtype=int)
+    d2 = np.empty((N,))
+    block_size = max(1, int(max_memory // (3 * 8 * max(len(mu), X.shape[1]))))
+    for start in range(0, N, block_size):
+        block = np.asarray(X[start:start + block_size], dtype=np.float64)
+        # |x|^2 is the same for all the centroids, it is only added to the distance of the nearest one
+        dist = mu_sq_norms[None, :] - 2.0 * (block @ mu.T)
+        C[start:start + len(block)] = np.argmin(dist, axis=1)
+        nearest = dist[np.arange(len(block)), C[start:start + len(block)]] + np.einsum('ij,ij->i', block, block)
+        # Rounding can produce small negative values for points (almost) on a centroid
+        d2[start:start + len(block)] = np.maximum(nearest, 0.0)
+    return C, d2
+
+
+def cluster_sums(X, C, K, max_memory=2**28):
+    """
+    Compute the sum and the number of the data points of each cluster.
+    
+    Inputs:
+    - X: Data matrix of size N x D.
+    - C: Cluster assignments vector of size N x 1.
+    - K: Number of clusters.
+    - max_memory: Approximate memory limit (bytes) of the blocks of data points read at once.
+    
+    Outputs:
+    - sums: Matrix of size K x D with the sum of the data points of each cluster.
+    - counts: Vector of size K with the number of data points of each cluster.
+    """
+    
+    N, D = X.shape
+    sums = np.zeros((K, D))
+    block_size = max(1, int(max_memory // (8 * D)))
+    for start in range(0, N, block_size):
+        block = np.asarray(X[start:start + block_size], dtype=np.float64)
+        codes = C[start:start + len(block)]
+        for d in range(D):
+            sums[:, d] += np.bincount(codes, weights=block[:, d], minlength=K)
+    counts = np.bincount(C, minlength=K)
+    return sums, counts
+
+
+def kmeans_plusplus(X, K, rng, max_memory=2**28):
     """
-    Compute K-means clustering on the data matrix X.
+    Choose K initial centroids with k-means++: the first centroid is a random data point, and each following centroid is a data point
+    drawn with a probability proportional to its squared distance to the closest centroid already chosen.
+    
+    Inputs:
+    - X: Data matrix of size N x D.
+    - K: Number of clusters.
+    - rng: numpy random Generator.
+    - max_memory: Approximate memory limit (bytes) of the blocks of distances (see nearest_centroids).
+    
+    Outputs:
+    - mu: Cluster centroid matrix of size K x D.
+    """
+    
+    N = X.shape[0]
+    mu = np.empty((K, X.shape[1]))
+    mu[0] = X[rng.integers(N)]
+    _, d2 = nearest_centroids(X, mu[:1], max_memory)
+    for k in range(1, K):
+        total = d2.sum()
+        if total > 0:
+            index = min(np.searchsorted(np.cumsum(d2), rng.random() * total, side='right'), N - 1)
+        else:
+            # All the points are on a centroid (fewer distinct points than clusters)
+            index = rng.integers(N)
+        mu[k] = X[index]
+        _, d2_new = nearest_centroids(X, mu[k:k + 1], max_memory)
+        np.minimum(d2, d2_new, out=d2)
+    return mu
+
+
+def _fill_empty_clusters(X, d2, mu, counts):
+    # Move the centroids of empty clusters to the data points farthest from their centroid (one point per empty cluster)
+    empty = np.flatnonzero(counts == 0)
+    if len(empty) > 0:
+        farthest = np.argsort(d2)[::-1][:len(empty)]
+        mu[empty] = X[farthest]
+
+
+def _tolerance(X, tol, max_memory=2**28):
+    # The tolerance is relative to the mean variance of the data dimensions, so it does not depend on the scale of the data
+    if tol == 0:
+        return 0.0
+    N, D = X.shape
+    mean = np.zeros((D,))
+    sq = np.zeros((D,))
+    block_size = max(1, int(max_memory // (8 * D)))
+    for start in range(0, N, block_size):
+        block = np.asarray(X[start:start + block_size], dtype=np.float64)
+        mean += block.sum(axis=0)
+        sq += np.einsum('ij,ij->j', block, block)
+    mean /= N
+    return tol * np.mean(np.maximum(sq / N - mean ** 2, 0.0))
+
+
+def k_means(X, K, max_iter=100, tol=1e-4, n_init=1, seed=None, init='k-means++', max_memory=2**28, return_inertia=False):
+    """
+    Compute K-means clustering on the data matrix X (Lloyd's algorithm).
+    
+    Each iteration assigns all the data points to their nearest centroid (in blocks, see nearest_centroids) and updates each centroid
+    as the mean of its data points. The iterations stop when the centroids move less than the tolerance, or when max_iter is reached.
+    Empty clusters get the data points farthest from their centroid, so no centroid is NaN.
     
     Inputs:
     - X: Data matrix of size N x D, where N is the number of data points and D is the number of dimensions.
     - K: Number of clusters.
     - max_iter: Maximum number of iterations.
+    - tol: Tolerance of the early stop, relative to the mean variance of the data dimensions. The iterations stop when the sum of the
+      squared displacements of the centroids is below it. With tol=0, they stop when the assignments do not change.
+    - n_init: Number of runs with different initial centroids. The run with the lowest inertia is returned.
+    - seed: Seed of the random generator (initial centroids), for reproducible results.
+    - init: Initialization of the centroids: 'k-means++' (default) or 'random' (K random data points).
+    - max_memory: Approximate memory limit (bytes) of the blocks of distances.
+    - return_inertia: If True, the inertia (sum of the squared distances of the data points to their centroid) is also returned.
     
     Outputs:
     - C: Cluster assignments vector of size N x 1, where each element is an integer representing the cluster assignment of the corresponding data point.
     - mu: Cluster centroid matrix of size K x D, where each row is a cluster centroid.
+    - inertia: Sum of the squared distances of the data points to their centroid (only if return_inertia is True).
     """
     
     N = X.shape[0]  # Number of data points
-    D = X.shape[1]  # Number of dimensions
-    mu = X[np.random.choice(N, K, replace=False), :]  # Randomly initialize cluster centroids
-    C = np.zeros((N,), dtype=int)  # Initialize cluster assignments
-    iter_count = 0
-    
-    while iter_count < max_iter:
-        # Assign each data point to the nearest centroid
-        for i in range(N):
-            C[i] = np.argmin(np.linalg.norm(X[i] - mu, axis=1))
+    if K < 1 or K > N:
+        raise ValueError("The number of clusters must be between 1 and the number of data points (" + str(N) + ")")
+    if init not in ['k-means++', 'random']:
+        raise ValueError("Unknown initialization: " + str(init) + ". Expected 'k-means++' or 'random'")
+    rng = np.random.default_rng(seed)
+    threshold = _tolerance(X, tol, max_memory)
+    
+    best = None
+    for run in range(max(1, n_init)):
+        # Initialize cluster centroids
+        if init == 'k-means++':
+            mu = kmeans_plusplus(X, K, rng, max_memory)
+        else:
+            mu = np.asarray(X[np.sort(rng.choice(N, K, replace=False))], dtype=np.float64)
+        C_prev = None
+        
+        for iter_count in range(max_iter):
+            # Assign each data point to the nearest centroid
+            C, d2 = nearest_centroids(X, mu, max_memory)
+            if tol == 0 and C_prev is not None and np.array_equal(C, C_prev):
+                break
+            
+            # Update each centroid as the mean of the assigned data points
+            sums, counts = cluster_sums(X, C, K, max_memory)
+            mu_new = np.empty_like(mu)
+            filled = counts > 0
+            mu_new[filled] = sums[filled] / counts[filled, None]
+            _fill_empty_clusters(X, d2, mu_new, counts)
+            
+            shift = np.sum((mu_new - mu) ** 2)
+            mu = mu_new
+            C_prev = C
+            if tol > 0 and shift <= threshold:
+                break
+        
+        # Final assignments and inertia of the run
+        C, d2 = nearest_centroids(X, mu, max_memory)
+        inertia = d2.sum()
+        if best is None or inertia < best[2]:
+            best = (C, mu, inertia)
+    
+    C, mu, inertia = best
+    if return_inertia:
+        return C, mu, inertia
+    return C, mu
+
+
+def mini_batch_k_means(X, K, batch_size=1024, max_iter=100, tol=0.0, max_no_improvement=10, init_size=None, n_init=3, seed=None,
+                       max_memory=2**28, return_inertia=False):
+    """
+    Compute K-means clustering on the data matrix X with mini-batches, for data that does not fit in memory.
+    
+    Each iteration draws a random batch of data points, assigns them to their nearest centroid and moves each centroid towards its
+    points with a per-centroid learning rate (1 / number of points assigned to it so far). Only the batches are loaded, so X can be a
+    memory mapped array (e.g. np.load(filename, mmap_mode='r')). The final assignments are computed in blocks over all the data points.
+    
+    Inputs:
+    - X: Data matrix of size N x D.
+    - K: Number of clusters.
+    - batch_size: Number of data points per batch.
+    - max_iter: Maximum number of passes over the data (epochs). Each pass is N / batch_size batches.
+    - tol: Tolerance of the early stop on the displacement of the centroids, relative to the mean variance of the batches (0 to disable).
+    - max_no_improvement: Stop when the smoothed inertia of the batches does not improve for this number of consecutive batches
+      (None to disable).
+    - init_size: Number of random data points used to choose the initial centroids (k-means++). Defaults to 3 x batch_size (at least K).
+    - n_init: Number of initializations. The one with the lowest inertia on the initialization points is used.
+    - seed: Seed of the random generator (initial centroids and batches), for reproducible results.
+    - max_memory: Approximate memory limit (bytes) of the blocks of distances.
+    - return_inertia: If True, the inertia (sum of the squared distances of the data points to their centroid) is also returned.
+    
+    Outputs:
+    - C: Cluster assignments vector of size N x 1.
+    - mu: Cluster centroid matrix of size K x D.
+    - inertia: Sum of the squared distances of the data points to their centroid (only if return_inertia is True).
+    """
+    
+    N = X.shape[0]  # Number of data points
+    if K < 1 or K > N:
+        raise ValueError("The number of clusters must be between 1 and the number of data points (" + str(N) + ")")
+    rng = np.random.default_rng(seed)
+    batch_size = min(batch_size, N)
+    if init_size is None:
+        init_size = 3 * batch_size
+    init_size = min(N, max(init_size, K))
+    
+    # Initial centroids: k-means++ on random subsets of the data, the best one on a common validation subset is kept
+    validation = np.asarray(X[np.sort(rng.choice(N, init_size, replace=False))], dtype=np.float64)
+    best = None
+    for run in range(max(1, n_init)):
+        sample = np.asarray(X[np.sort(rng.choice(N, init_size, replace=False))], dtype=np.float64)
+        mu_init = kmeans_plusplus(sample, K, rng, max_memory)
+        _, d2 = nearest_centroids(validation, mu_init, max_memory)
+        if best is None or d2.sum() < best[1]:
+            best = (mu_init, d2.sum())
+    mu = best[0]
+    
+    counts = np.zeros((K,))  # Number of data points assigned to each centroid so far
+    ewa_inertia = None
+    best_inertia = np.inf
+    no_improvement = 0
+    n_batches = max_iter * max(1, N // batch_size)
+    for batch_count in range(n_batches):
+        # Random batch (sorted indices, so memory mapped data is read in order)
+        batch = np.asarray(X[np.sort(rng.choice(N, batch_size, replace=False))], dtype=np.float64)
+        C, d2 = nearest_centroids(batch, mu, max_memory)
+        
+        # Move each centroid towards the mean of its points of the batch
+        sums, batch_counts = cluster_sums(batch, C, K, max_memory)
+        assigned = batch_counts > 0
+        counts[assigned] += batch_counts[assigned]
+        rate = batch_counts[assigned] / counts[assigned]
+        mu_new = mu.copy()
+        mu_new[assigned] += rate[:, None] * (sums[assigned] / batch_counts[assigned, None] - mu[assigned])
+        
+        # Centroids that have (almost) no points are moved to the batch points farthest from their centroid
+        starving = np.flatnonzero(counts < 1e-3 * counts.max())
+        if len(starving) > 0:
+            farthest = np.argsort(d2)[::-1][:len(starving)]
+            mu_new[starving[:len(farthest)]] = batch[farthest]
+            counts[starving[:len(farthest)]] = counts[assigned].min() if assigned.any() else 1
         
-        # Update each centroid as the mean of the assigned data points
-        for k in range(K):
-            mu[k] = np.mean(X[C == k], axis=0)
+        shift = np.sum((mu_new - mu) ** 2)
+        mu = mu_new
         
-        iter_count += 1
+        # Early stop: small displacement of the centroids
+        if tol > 0 and shift <= tol * np.mean(batch.var(axis=0)):
+            break
+        # Early stop: no improvement of the smoothed inertia of the batches
+        batch_inertia = d2.sum() / batch_size
+        alpha = min(1.0, 2.0 * batch_size / (N + 1))
+        ewa_inertia = batch_inertia if ewa_inertia is None else ewa_inertia * (1 - alpha) + batch_inertia * alpha
+        if ewa_inertia < best_inertia:
+            best_inertia = ewa_inertia
+            no_improvement = 0
+        else:
+            no_improvement += 1
+        if max_no_improvement is not None and no_improvement >= max_no_improvement:
+            break
     
+    # Final assignments over all the data points
+    C, d2 = nearest_centroids(X, mu, max_memory)
+    if return_inertia:
+        return C, mu, d2.sum()
     return C, mu
 
 